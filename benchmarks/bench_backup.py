@@ -0,0 +1,84 @@
+"""Bytes uploaded per pin change, and restore time, for whole-file backups
+versus incremental (base snapshot + compressed delta) backups.
+
+Each pin change is backed up on its own (i.e. no coalescing), against a
+local S3 stand-in.
+
+    python benchmarks/bench_backup.py [--pins N] [--changes N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                '..', 'discord_quote', 'discord_quote'))
+
+import backup
+from local_bucket import LocalBucket
+from pin_db import PinDatabase
+
+INSERT = ("INSERT INTO pins (alias, msg_url, pin_user, pin_time, guild_id, "
+          "alias_norm) VALUES (?, ?, ?, ?, ?, ?)")
+
+def pin(i):
+    return((f'alias {i}', f'https://discord.com/channels/1/2/{i}',
+            'bench', '2020-01-01 00:00:00', 1, f'alias {i}'))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pins', type=int, default=20000)
+    parser.add_argument('--changes', type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = PinDatabase(os.path.join(tmp, 'pins.db'))
+        db.execute_batch([(INSERT, pin(i)) for i in range(args.pins)])
+        db.changelog = True
+
+        full = LocalBucket(os.path.join(tmp, 'full'))
+        incremental = LocalBucket(os.path.join(tmp, 'incremental'))
+        scheduler = backup.BackupScheduler(db, incremental, 'pins.db',
+                                           compact_after=args.changes + 1)
+        scheduler._backup()   # initial base snapshot
+        base_bytes = incremental.bytes_uploaded
+        incremental.bytes_uploaded = 0
+
+        async def changes():
+            for i in range(args.pins, args.pins + args.changes):
+                await db.write(INSERT, pin(i))
+
+                # Whole-file backup of the same change
+                snapshot = os.path.join(tmp, 'snapshot.db')
+                db.snapshot(snapshot)
+                full.upload_file(snapshot, 'pins.db')
+
+                scheduler._backup()
+
+        asyncio.run(changes())
+        scheduler.flush()
+
+        print(f"base snapshot (compressed)   {base_bytes:>10,} bytes")
+        print(f"whole-file   per change      "
+              f"{full.bytes_uploaded // args.changes:>10,} bytes")
+        print(f"incremental  per change      "
+              f"{incremental.bytes_uploaded // args.changes:>10,} bytes")
+
+        for name, bucket in (('whole-file', full), ('incremental', incremental)):
+            path = os.path.join(tmp, f'restored-{name}.db')
+            start = time.perf_counter()
+            backup.restore(bucket, 'pins.db', path)
+            elapsed = time.perf_counter() - start
+
+            restored = PinDatabase(path)
+            count = restored.execute("SELECT count(*) FROM pins")[0][0]
+            restored.close()
+            print(f"{name:<12} restore         {elapsed * 1e3:>10.1f} ms  "
+                  f"({count:,} pins)")
+
+        db.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""End-to-end time to format a requote of a deep quote chain.
+
+Builds a quote whose text references `--depth` earlier messages (a chain
+of quotes of quotes), served by a fake channel that takes `--latency`
+seconds per `fetch_message()`, and times `_format_quote()` with a cold
+message cache. Fetching the earlier messages one at a time would take
+about depth * latency. (This is the fallback for quotes sent before
+quote chains were recorded; recorded quotes render without any fetches.)
+
+Needs the bot's runtime environment (run from anywhere; imports
+`discord_quote.py` from the bot directory).
+
+    python benchmarks/bench_format_quote.py [--depth N] [--latency S]
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BOT_DIR)
+
+def build_chain(depth, now):
+    channel = SimpleNamespace(id=2, name='general')
+    guild = SimpleNamespace(id=1, get_channel=lambda channel_id: channel)
+    earlier = {}
+
+    lines = []
+    for level in range(depth):
+        msg_id = 1000 + level
+        created_at = now - datetime.timedelta(hours=depth - level + 1)
+        earlier[msg_id] = SimpleNamespace(
+            id=msg_id,
+            created_at=created_at,
+            author=SimpleNamespace(name=f'user{level}'),
+            clean_content=f'message {level}',
+        )
+        action = 'said' if level == 0 else 'responded'
+        lines.append(
+            f"**user{level} {action} [{depth - level} hours ago]"
+            f"(<https://discord.com/channels/1/2/{msg_id}>):** message {level}"
+        )
+    lines.append(f"**user{depth} responded:** message {depth}")
+
+    async def fetch_message(msg_id):
+        await asyncio.sleep(channel.latency)
+        return(earlier[int(msg_id)])
+    channel.fetch_message = fetch_message
+
+    quote = SimpleNamespace(
+        id=2000,
+        content='\n'.join(lines),
+        created_at=now,
+        jump_url='https://discord.com/channels/1/2/2000',
+    )
+    ctx = SimpleNamespace(
+        channel=channel,
+        guild=guild,
+        message=SimpleNamespace(
+            created_at=now,
+            channel=channel,
+            author=SimpleNamespace(name='requoter'),
+        ),
+    )
+    return(ctx, quote, channel)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # The bot opens its database relative to the working directory
+    tmp = tempfile.mkdtemp()
+    # No bucket, so no backups
+    os.environ['DISCORD_QUOTEBOT_BUCKET'] = ''
+    os.environ['DISCORD_QUOTEBOT_DB_FILENAME'] = os.path.relpath(
+        os.path.join(tmp, 'pins.db'), BOT_DIR)
+    os.chdir(BOT_DIR)
+
+    import discord_quote as bot
+    from message_cache import MessageCache
+
+    now = datetime.datetime.utcnow()
+    ctx, quote, channel = build_chain(args.depth, now)
+    channel.latency = args.latency
+
+    timings = []
+    for _ in range(args.repeat):
+        bot.messages = MessageCache()    # cold cache every run
+        start = time.perf_counter()
+        output = asyncio.get_event_loop().run_until_complete(
+            bot._format_quote(ctx, quote))
+        timings.append(time.perf_counter() - start)
+
+    assert output.count('hours ago') == args.depth
+    print(f"depth {args.depth}, {args.latency * 1e3:.0f} ms per fetch: "
+          f"best {min(timings) * 1e3:.1f} ms "
+          f"(sequential would be ~{args.depth * args.latency * 1e3:.0f} ms)")
+
+if __name__ == '__main__':
+    main()
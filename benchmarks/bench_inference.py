@@ -0,0 +1,138 @@
+"""Author model inference throughput, by batch size.
+
+Runs `author_model.predict_batch()` on batches of 1, 8 and 32 messages
+(of equal length, so every batch is one forward pass), then pushes the
+same messages through `InferenceService` from many concurrent coroutines
+to measure the batching worker end to end: with equal-length messages
+for a few batch sizes, then with lengths spread over 3-30 tokens for a
+few `max_pad` settings (how far apart in length messages may be and
+still share a batch). Finally times a prediction cache hit against a
+miss.
+
+Uses the real checkpoint with `--checkpoint`; otherwise a randomly
+initialized `AuthorNet` over a synthetic vocabulary of `--vocab` words
+(the throughput doesn't depend on the weights). Needs torch.
+
+    python benchmarks/bench_inference.py [--checkpoint PATH] [--threads 2]
+                                         [--tokens 16] [--requests 512]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                '..', 'discord_quote', 'discord_quote'))
+
+import torch
+
+import author_model
+from AuthorNet import AuthorNet
+
+class SyntheticVocab:
+    def __init__(self, size):
+        self.itos = ['<unk>', '<pad>'] + [f'word{i}' for i in range(size - 2)]
+        self.stoi = {word: i for i, word in enumerate(self.itos)}
+
+    def __len__(self):
+        return(len(self.itos))
+
+def messages(vocab, n, tokens):
+    """`n` messages of `tokens` words, or of a random number of words if
+    `tokens` is a range.
+    """
+    words = [word for word in vocab.itos if not word.startswith('<')]
+    lengths = [random.choice(tokens) if isinstance(tokens, range) else tokens
+               for _ in range(n)]
+    return([' '.join(random.choices(words, k=length)) for length in lengths])
+
+def bench_batches(inputs, sizes, min_time=1.0):
+    for size in sizes:
+        batch = inputs[:size]
+        author_model.predict_batch(batch)  # warm up
+        runs = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < min_time:
+            author_model.predict_batch(batch)
+            runs += 1
+        elapsed = time.perf_counter() - start
+        print(f"batch {size:>3}: {runs * size / elapsed:>8.0f} messages/s, "
+              f"{elapsed / runs * 1e3:>7.2f} ms/batch")
+
+async def bench_service(texts, window, max_batch, threads, max_pad=0):
+    # Start from an empty prediction cache, so every message is predicted
+    author_model.PREDICTIONS.invalidate()
+    service = author_model.InferenceService(window=window,
+                                            max_batch=max_batch,
+                                            threads=threads,
+                                            max_pad=max_pad).start()
+    await service.predict(texts[0], 12)  # warm up
+    batches, requests = service.batches, service.requests
+
+    start = time.perf_counter()
+    await asyncio.gather(*[service.predict(text, random.randrange(24))
+                           for text in texts])
+    elapsed = time.perf_counter() - start
+    service.close()
+
+    batches = service.batches - batches
+    print(f"service (window {window * 1e3:.0f} ms, max batch {max_batch}, "
+          f"max pad {max_pad}): {len(texts) / elapsed:.0f} messages/s, "
+          f"mean batch {(service.requests - requests) / batches:.1f}")
+
+def bench_cache(texts, n=200):
+    author_model.PREDICTIONS.invalidate()
+    start = time.perf_counter()
+    for text in texts[:n]:
+        author_model.author_probabilities(text, 12)
+    miss = (time.perf_counter() - start) / n
+    start = time.perf_counter()
+    for text in texts[:n]:
+        author_model.author_probabilities(text, 12)
+    hit = (time.perf_counter() - start) / n
+    hits, misses, size = author_model.PREDICTIONS.stats()
+    print(f"prediction cache: miss {miss * 1e3:.3f} ms, hit {hit * 1e6:.1f} us "
+          f"({hits} hits, {misses} misses, {size} entries)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--vocab', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=2)
+    parser.add_argument('--tokens', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=512)
+    args = parser.parse_args()
+    random.seed(0)
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads)
+
+    if args.checkpoint:
+        author_model.load(args.checkpoint)
+    else:
+        vocab = SyntheticVocab(args.vocab)
+        net = AuthorNet(24, 11, vocab)
+        net.eval()
+        author_model._NET, author_model._VOCAB = net, vocab
+    vocab = author_model._VOCAB
+
+    print(f"torch {torch.__version__}, {torch.get_num_threads()} threads, "
+          f"{args.tokens} tokens per message")
+
+    texts = messages(vocab, max(32, args.requests), args.tokens)
+    inputs = [author_model.msg_to_input(text, random.randrange(24), vocab)
+              for text in texts[:32]]
+    bench_batches(inputs, [1, 8, 32])
+
+    for max_batch in (1, 8, 32):
+        asyncio.run(bench_service(texts[:args.requests], 0.005, max_batch, args.threads))
+
+    varied = messages(vocab, args.requests, range(3, 31))
+    for max_pad in (0, 4, 8):
+        asyncio.run(bench_service(varied, 0.005, 32, args.threads, max_pad))
+
+    bench_cache(texts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Overhead of the metrics registry, and an offline check of the endpoint.
+
+Times `Histogram.observe()`/`Counter.inc()` (what every command, Discord
+API request and database query pays), then serves the registry on an
+ephemeral local port, records some synthetic traffic, scrapes
+`/metrics` like Prometheus would, and checks the histogram counts add up.
+Needs nothing but the standard library.
+
+    python benchmarks/bench_metrics.py [--observations N]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                '..', 'discord_quote', 'discord_quote'))
+
+import metrics
+
+async def scrape(port, path='/metrics'):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n'.encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return(head.split(b'\r\n')[0].decode(), body.decode())
+
+async def run(observations):
+    registry = metrics.Registry()
+    commands = registry.histogram('bench_command_seconds', 'Bench commands.',
+                                  ('command', 'outcome'))
+    requests = registry.counter('bench_requests_total', 'Bench requests.',
+                                ('route',))
+
+    server = await metrics.serve('127.0.0.1', 0, registry=registry)
+    port = server.sockets[0].getsockname()[1]
+
+    for _ in range(observations):
+        commands.observe(random.expovariate(20),
+                         command=random.choice(['quote', 'get', 'list']),
+                         outcome='ok')
+        requests.inc(route='/channels/{channel_id}/messages/{message_id}')
+
+    start = time.perf_counter()
+    status, body = await scrape(port)
+    scrape_time = time.perf_counter() - start
+
+    counts = [int(line.split()[-1]) for line in body.splitlines()
+              if line.startswith('bench_command_seconds_count')]
+    assert status.endswith('200 OK'), status
+    assert sum(counts) == observations, (sum(counts), observations)
+    assert f'bench_requests_total{{route="/channels/{{channel_id}}/messages/{{message_id}}"}} {observations}' in body
+
+    status, _ = await scrape(port, '/other')
+    assert status.endswith('404 Not Found'), status
+
+    server.close()
+    await server.wait_closed()
+    return(scrape_time, len(body))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--observations', type=int, default=10000)
+    args = parser.parse_args()
+
+    registry = metrics.Registry()
+    histogram = registry.histogram('h', 'h', ('command', 'outcome'))
+    counter = registry.counter('c', 'c', ('route',))
+    n = 100000
+    observe = min(timeit.repeat(
+        lambda: histogram.observe(0.01, command='quote', outcome='ok'),
+        number=n, repeat=5)) / n
+    inc = min(timeit.repeat(lambda: counter.inc(route='/x'), number=n, repeat=5)) / n
+    print(f"observe: {observe * 1e6:.2f} us, inc: {inc * 1e6:.2f} us")
+
+    scrape_time, size = asyncio.run(run(args.observations))
+    print(f"scrape after {args.observations} observations: "
+          f"{scrape_time * 1e3:.2f} ms, {size} bytes, counts check out")
+
+if __name__ == '__main__':
+    main()
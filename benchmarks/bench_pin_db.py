@@ -0,0 +1,152 @@
+"""Per-query latency of `!get`-style alias lookups against the pin database.
+
+Compares the old access pattern (open a new connection, create the table,
+scan for `lower(alias)`, close -- for every query) against the long-lived
+`PinDatabase` connection probing the `(guild_id, alias_norm)` index (called
+directly, and through the async worker-thread API),
+with a few hundred lookups issued concurrently from the event loop the way
+the bot's commands issue them. Also times a burst of `!put`-style inserts
+committed one-by-one versus batched by `PinDatabase.write()`.
+
+"stall" is the longest the event loop went without running a 1 ms
+heartbeat, i.e. how long a gateway heartbeat could have been delayed.
+
+    python benchmarks/bench_pin_db.py [--pins N] [--requests N]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                '..', 'discord_quote', 'discord_quote'))
+
+from pin_db import PinDatabase
+
+GET_QUERY = "SELECT msg_url FROM pins WHERE guild_id = ? AND alias_norm = ?"
+
+def legacy_get(path, alias):
+    query = f"SELECT msg_url FROM pins WHERE lower(alias)=\"{alias}\""
+    with sqlite3.connect(path) as conn:
+        c = conn.cursor()
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pins (
+            alias TEXT, msg_url TEXT, pin_user TEXT, pin_time TEXT
+            )
+            """
+        )
+        c.execute(query)
+        return(c.fetchall())
+
+def populate(path, n_pins):
+    # Old-style rows; opening the file with PinDatabase migrates them.
+    rows = [(f'alias {i}',
+             f'https://discord.com/channels/1/2/{i}',
+             'bench',
+             '2020-01-01 00:00:00') for i in range(n_pins)]
+    with sqlite3.connect(path) as conn:
+        legacy_get(path, '')
+        conn.executemany("INSERT INTO pins VALUES (?, ?, ?, ?)", rows)
+
+async def heartbeat(stalls, stop):
+    last = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(0.001)
+        now = time.perf_counter()
+        stalls.append(now - last - 0.001)
+        last = now
+
+async def run(get_pin, n_requests, n_pins):
+    latencies = []
+    stalls = []
+    stop = asyncio.Event()
+    monitor = asyncio.ensure_future(heartbeat(stalls, stop))
+    await asyncio.sleep(0.002)
+
+    async def get(i):
+        alias = f'alias {i % n_pins}'
+        start = time.perf_counter()
+        result = get_pin(alias)
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[get(i) for i in range(n_requests)])
+    total = time.perf_counter() - start
+
+    stop.set()
+    await monitor
+    return(latencies, total, max(stalls))
+
+async def put_burst(db, n_requests, batched):
+    query = ("INSERT INTO pins (alias, msg_url, pin_user, pin_time, "
+             "guild_id, alias_norm) VALUES (?, ?, ?, ?, ?, ?)")
+
+    async def put(i):
+        params = (f'burst {i}', '', 'bench', '', 1, f'burst {i}')
+        if batched:
+            await db.write(query, params)
+        else:
+            db.execute_batch([(query, params)])
+
+    start = time.perf_counter()
+    await asyncio.gather(*[put(i) for i in range(n_requests)])
+    return(time.perf_counter() - start)
+
+def report(name, latencies, total, stall):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<12} mean {statistics.mean(latencies) * 1e3:8.3f} ms  "
+          f"p50 {statistics.median(latencies) * 1e3:8.3f} ms  "
+          f"p99 {p99 * 1e3:8.3f} ms  "
+          f"total {total * 1e3:9.1f} ms  "
+          f"stall {stall * 1e3:8.3f} ms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pins', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, 'legacy.db')
+        populate(legacy_path, args.pins)
+        latencies, total, stall = asyncio.run(
+            run(lambda alias: legacy_get(legacy_path, alias),
+                args.requests, args.pins))
+        report('per-query', latencies, total, stall)
+
+        path = os.path.join(tmp, 'pins.db')
+        populate(path, args.pins)
+        db = PinDatabase(path)
+        db.connect()    # run the migration outside the timed section
+        latencies, total, stall = asyncio.run(
+            run(lambda alias: db.execute(GET_QUERY, (1, alias)),
+                args.requests, args.pins))
+        report('long-lived', latencies, total, stall)
+
+        latencies, total, stall = asyncio.run(
+            run(lambda alias: db.fetch(GET_QUERY, (1, alias)),
+                args.requests, args.pins))
+        report('worker', latencies, total, stall)
+        db.close()
+
+        db = PinDatabase(path)
+        total = asyncio.run(put_burst(db, args.requests, batched=False))
+        print(f"put burst    one commit per insert   total {total * 1e3:9.1f} ms")
+        db.close()
+
+        db = PinDatabase(path)
+        db.execute("DELETE FROM pins WHERE alias LIKE 'burst %'")
+        total = asyncio.run(put_burst(db, args.requests, batched=True))
+        print(f"put burst    batched commits         total {total * 1e3:9.1f} ms")
+        db.close()
+
+if __name__ == '__main__':
+    main()
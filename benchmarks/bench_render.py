@@ -0,0 +1,77 @@
+"""Scaling of block quote formatting with the number of lines in a message.
+
+Times the old `block_format` (which rebuilt the whole string once per line,
+so O(lines * length)) against `render.block_format`, and a full
+`render.webhook_quote` of the same message, for messages of increasing
+line counts. Linear scaling shows as a constant time per line.
+
+    python benchmarks/bench_render.py [--lines 1000,2000,4000,8000,16000]
+"""
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                '..', 'discord_quote', 'discord_quote'))
+
+import render
+
+def legacy_block_format(message):
+    # Find new line positions
+    insert_idx = [pos for pos, char in enumerate(message) if char == "\n"]
+    insert_idx.insert(0, -1)
+
+    # Insert "> " for block quote formatting
+    for offset, i in enumerate(insert_idx):
+
+        message = (message[:i + (2 * offset) + 1] +
+                  "> " +
+                  message[i + (2 * offset) + 1:])
+
+    return(message)
+
+def chain_for(content, now):
+    return({
+        'source': {
+            'author': 'someone',
+            'content': content,
+            'created_at': (now - datetime.timedelta(hours=3)).isoformat(),
+            'jump_url': 'https://discord.com/channels/1/2/3',
+            'guild_id': 1,
+            'channel_id': 2,
+            'channel_name': 'general',
+            'message_id': 3,
+        },
+        'responses': [{'author': 'requester', 'text': 'this', 'created_at': None,
+                       'jump_url': None}],
+    })
+
+def best(fn, repeat):
+    return(min(timeit.repeat(fn, number=1, repeat=repeat)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', default='1000,2000,4000,8000,16000')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    now = datetime.datetime.utcnow()
+    print(f"{'lines':>6} {'legacy ms':>10} {'us/line':>8} "
+          f"{'render ms':>10} {'us/line':>8} {'quote ms':>9}")
+    for lines in [int(n) for n in args.lines.split(',')]:
+        message = '\n'.join(f'line {i} of a long message' for i in range(lines))
+        assert legacy_block_format(message) == render.block_format(message)
+
+        legacy = best(lambda: legacy_block_format(message), args.repeat)
+        linear = best(lambda: render.block_format(message), args.repeat)
+        chain = chain_for(message, now)
+        quote = best(lambda: render.webhook_quote(chain, now), args.repeat)
+
+        print(f"{lines:>6} {legacy * 1e3:>10.2f} {legacy / lines * 1e6:>8.2f} "
+              f"{linear * 1e3:>10.3f} {linear / lines * 1e6:>8.3f} "
+              f"{quote * 1e3:>9.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Bot startup time, by phase.
+
+Imports `discord_quote` in a fresh interpreter, `--runs` times, and
+reports how long the import took (everything before `bot.run()` can
+start logging in) and whether it imported torch. Trees with startup
+phase timings (`discord_quote.STARTUP`) also have their background
+phases waited for and reported: the database (with S3 setup) and the
+author model, which the bot normally starts loading after login. Login
+itself needs Discord, so it isn't timed.
+
+Runs offline, in a temporary working directory: a throwaway database,
+no AWS credentials (so S3 setup fails fast instead of reaching AWS), and
+the author checkpoint, if given, linked in under the name the bot looks
+for. `--tree` times another checkout, e.g. a `git worktree` of an older
+commit; trees that predate the empty-bucket setting need `--bucket`.
+
+    python benchmarks/bench_startup.py [--tree PATH] [--checkpoint PATH]
+                                       [--bucket NAME] [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CHECKPOINT_NAME = 'Candidate_1_Adam_06701'
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import discord_quote as bot
+result = {'import': time.perf_counter() - start,
+          'torch': 'torch' in sys.modules}
+if hasattr(bot, 'STARTUP'):
+    bot.db_ready.result()
+    try:
+        bot.model_ready().result()
+    except Exception as e:
+        result['model_error'] = f'{type(e).__name__}: {e}'
+    result['phases'] = dict(bot.STARTUP)
+print(json.dumps(result))
+'''
+
+def run_once(bot_dir, checkpoint, bucket):
+    with tempfile.TemporaryDirectory() as cwd:
+        if checkpoint:
+            os.symlink(os.path.abspath(checkpoint), os.path.join(cwd, CHECKPOINT_NAME))
+
+        env = {name: value for name, value in os.environ.items()
+               if not name.startswith('AWS_')}
+        env.update({
+            'PYTHONPATH': bot_dir,
+            'AWS_EC2_METADATA_DISABLED': 'true',
+            'DISCORD_QUOTEBOT_BUCKET': bucket,
+            'DISCORD_QUOTEBOT_DB_FILENAME': 'pins.db',
+            'DISCORD_QUOTEBOT_METRICS_PORT': '0',
+            'DISCORD_QUOTEBOT_LOG_LEVEL': 'WARNING',
+        })
+        out = subprocess.run([sys.executable, '-c', CHILD], cwd=cwd, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        if out.returncode != 0:
+            sys.exit(f"import failed:\n{out.stderr}")
+        return(json.loads(out.stdout.strip().splitlines()[-1]))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tree', default=REPO)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--bucket', default='')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    bot_dir = os.path.join(os.path.abspath(args.tree), 'discord_quote', 'discord_quote')
+    results = [run_once(bot_dir, args.checkpoint, args.bucket) for _ in range(args.runs)]
+
+    print(f"{args.runs} runs of {bot_dir}, medians:")
+    print(f"  {'import (until bot.run)':<24} {statistics.median(r['import'] for r in results):>7.3f}s"
+          f"  torch imported: {results[0]['torch']}")
+    for phase in results[0].get('phases', {}):
+        print(f"  {phase:<24} {statistics.median(r['phases'][phase] for r in results):>7.3f}s")
+    if 'model_error' in results[0]:
+        print(f"  model failed to load: {results[0]['model_error']}")
+
+if __name__ == '__main__':
+    main()
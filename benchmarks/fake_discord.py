@@ -0,0 +1,264 @@
+"""An offline stand-in for the parts of Discord the bot uses.
+
+Channels, messages, webhooks and users behave like their discord.py
+counterparts for the calls the bot makes (`fetch_message`, `send`,
+`webhooks`, `create_webhook`, `Webhook.send`, `Message.delete`,
+`add_reaction`, `history`, plus `Bot.wait_for`, `fetch_user` and
+`get_guild` via `FakeDiscord.attach()`), keeping everything in memory.
+
+Every API call sleeps for `latency` seconds (+/- `jitter`). With
+`rate_limit` set, each route allows that many requests per second; a
+request over the limit is answered with a 429 and, like discord.py's HTTP
+client, waits out the `retry_after` and tries again, so it shows up as
+extra latency (and in `rate_limited`). `error_rate` makes that fraction of
+requests fail with a 500 instead.
+
+Needs discord.py installed (for its exception types).
+"""
+import asyncio
+import collections
+import datetime
+import itertools
+import random
+from types import SimpleNamespace
+
+import discord
+
+def _response(status, reason):
+    return(SimpleNamespace(status=status, reason=reason))
+
+class FakeDiscord:
+    def __init__(self, latency=0.05, jitter=0.5, rate_limit=None, error_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+
+        self.requests = collections.Counter()
+        self.rate_limited = 0
+        self.errors = 0
+
+        self._next_slot = {}
+        # Snowflake-ish ids, increasing with time
+        self._ids = itertools.count(700000000000000000)
+        self.guilds = {}
+        self.users = {}
+        self.bot_user = self.user('quote-bot', bot=True)
+
+    def new_id(self):
+        return(next(self._ids))
+
+    async def request(self, method, route):
+        """Simulates one API request to `route` (a route template)."""
+        self.requests[f'{method} {route}'] += 1
+
+        if self.rate_limit:
+            loop = asyncio.get_event_loop()
+            now = loop.time()
+            slot = max(self._next_slot.get(route, now), now)
+            self._next_slot[route] = slot + 1 / self.rate_limit
+            if slot > now:
+                # 429, then retry after `retry_after`
+                self.rate_limited += 1
+                await asyncio.sleep(slot - now)
+
+        await asyncio.sleep(self.latency * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            raise discord.HTTPException(_response(500, 'Internal Server Error'),
+                                        'Simulated server error')
+
+    # --- Setup
+    def user(self, name, bot=False):
+        user = FakeUser(self, self.new_id(), name, bot=bot)
+        self.users[user.id] = user
+        return(user)
+
+    def guild(self, name):
+        guild = FakeGuild(self, self.new_id(), name)
+        self.guilds[guild.id] = guild
+        return(guild)
+
+    def attach(self, bot):
+        """Points a `commands.Bot` at this fake: its user, `wait_for`,
+        `fetch_user` and `get_guild`.
+        """
+        bot._connection.user = self.bot_user
+        bot.wait_for = self.wait_for
+        bot.fetch_user = self.fetch_user
+        bot.get_guild = self.guilds.get
+
+    async def fetch_user(self, user_id):
+        await self.request('GET', '/users/{user_id}')
+        return(self.users[user_id])
+
+    async def wait_for(self, event, check=None, timeout=None):
+        # Users answer DMs straight away, and never page through `!list`
+        await asyncio.sleep(0)
+        if event == 'message':
+            return(FakeMessage(self, self.new_id(), None, self.bot_user,
+                               'something entirely plausible'))
+        raise asyncio.TimeoutError()
+
+class FakeUser:
+    def __init__(self, fake, id, name, bot=False):
+        self._fake = fake
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.mention = f'<@{id}>'
+        self.avatar_url = f'https://cdn.example/avatars/{id}.png'
+        self.guild_permissions = SimpleNamespace(manage_guild=True)
+        self._dm = None
+
+    def __str__(self):
+        return(self.name)
+
+    async def send(self, content=None, **kwargs):
+        if self._dm is None:
+            self._dm = FakeChannel(self._fake, self._fake.new_id(), f'dm-{self.name}', None)
+        return(await self._dm.send(content, **kwargs))
+
+class FakeGuild:
+    def __init__(self, fake, id, name):
+        self._fake = fake
+        self.id = id
+        self.name = name
+        self.channels = {}
+        self.me = fake.bot_user
+
+    def channel(self, name, manage_webhooks=True):
+        channel = FakeChannel(self._fake, self._fake.new_id(), name, self,
+                              manage_webhooks=manage_webhooks)
+        self.channels[channel.id] = channel
+        return(channel)
+
+    def get_channel(self, channel_id):
+        return(self.channels.get(int(channel_id)))
+
+class FakeChannel:
+    def __init__(self, fake, id, name, guild, manage_webhooks=True):
+        self._fake = fake
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.manage_webhooks = manage_webhooks
+        self.messages = {}
+        self._webhooks = []
+
+    def permissions_for(self, member):
+        return(SimpleNamespace(manage_webhooks=self.manage_webhooks,
+                               send_messages=True))
+
+    def post(self, author, content, created_at=None):
+        """Adds a message (without an API call), e.g., to seed the channel."""
+        message = FakeMessage(self._fake, self._fake.new_id(), self, author,
+                              content, created_at=created_at)
+        self.messages[message.id] = message
+        return(message)
+
+    async def fetch_message(self, msg_id):
+        await self._fake.request('GET', '/channels/{channel_id}/messages/{message_id}')
+        try:
+            return(self.messages[int(msg_id)])
+        except KeyError:
+            raise discord.NotFound(_response(404, 'Not Found'), 'Unknown Message')
+
+    async def send(self, content=None, **kwargs):
+        await self._fake.request('POST', '/channels/{channel_id}/messages')
+        return(self.post(self._fake.bot_user, content or ''))
+
+    async def webhooks(self):
+        await self._fake.request('GET', '/channels/{channel_id}/webhooks')
+        return([*self._webhooks])
+
+    async def create_webhook(self, name, **kwargs):
+        await self._fake.request('POST', '/channels/{channel_id}/webhooks')
+        hook = FakeWebhook(self._fake, self._fake.new_id(), self, name)
+        self._webhooks.append(hook)
+        return(hook)
+
+    def history(self, limit=100):
+        return(_History(self, limit))
+
+class _History:
+    def __init__(self, channel, limit):
+        self._channel = channel
+        self._limit = limit
+
+    async def _messages(self):
+        await self._channel._fake.request('GET', '/channels/{channel_id}/messages')
+        newest = sorted(self._channel.messages, reverse=True)
+        return([self._channel.messages[i] for i in newest[:self._limit]])
+
+    def __aiter__(self):
+        return(self._iterate())
+
+    async def _iterate(self):
+        for message in await self._messages():
+            yield message
+
+    async def flatten(self):
+        return(await self._messages())
+
+class FakeWebhook:
+    def __init__(self, fake, id, channel, name):
+        self._fake = fake
+        self.id = id
+        self.channel = channel
+        self.channel_id = channel.id
+        self.name = name
+
+    async def send(self, content=None, username=None, avatar_url=None,
+                   wait=False, files=None, **kwargs):
+        await self._fake.request('POST', '/webhooks/{webhook_id}/{webhook_token}')
+        author = FakeUser(self._fake, self.id, username or self.name, bot=True)
+        message = self.channel.post(author, content or '')
+        return(message if wait else None)
+
+class FakeMessage:
+    def __init__(self, fake, id, channel, author, content, created_at=None):
+        self._fake = fake
+        self.id = id
+        self.channel = channel
+        self.guild = channel.guild if channel is not None else None
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.created_at = created_at or datetime.datetime.utcnow()
+        self.attachments = []
+        self.webhook_id = None
+
+    @property
+    def jump_url(self):
+        guild_id = self.guild.id if self.guild else '@me'
+        return(f'https://discord.com/channels/{guild_id}/{self.channel.id}/{self.id}')
+
+    async def delete(self):
+        await self._fake.request('DELETE', '/channels/{channel_id}/messages/{message_id}')
+        if self.channel is not None:
+            self.channel.messages.pop(self.id, None)
+
+    async def add_reaction(self, emoji):
+        await self._fake.request(
+            'PUT', '/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me')
+
+class FakeContext:
+    """A `commands.Context` for a command message `message`."""
+
+    def __init__(self, bot, message, command):
+        self.bot = bot
+        self.message = message
+        self.channel = message.channel
+        self.guild = message.guild
+        self.author = message.author
+        self.command = command
+        self.command_failed = False
+
+    async def send(self, content=None, **kwargs):
+        return(await self.channel.send(content, **kwargs))
+
+    async def invoke(self, command, *args, **kwargs):
+        return(await command.callback(self, *args, **kwargs))
@@ -0,0 +1,189 @@
+"""End-to-end load test of the bot's commands against an offline Discord.
+
+Seeds a fake guild (see `fake_discord.py`) with messages, then drives
+`quote`, `put`, `get`, `list`, `delete` and `misquote` through the bot's
+real command callbacks (and before-invoke hooks) at `--rate` commands per
+second (Poisson arrivals, open loop) for `--duration` seconds. Reports
+throughput, p50/p99 latency and errors per command, plus the Discord API
+requests made and how many hit the simulated rate limit.
+
+Runs fully offline: backups are off (no bucket), and the database is
+a temporary file. Needs the bot's Python dependencies (discord.py, arrow,
+boto3, ...) installed. `misquote` names its target, so it doesn't need
+the author model.
+
+    python benchmarks/load_test.py [--rate 20] [--duration 30] [--latency 0.05]
+                                   [--rate-limit 5] [--error-rate 0]
+                                   [--mix quote=5,get=3,put=1,list=1,delete=1,misquote=1]
+"""
+import argparse
+import asyncio
+import collections
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.join(BENCH_DIR, '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, BOT_DIR)
+
+from fake_discord import FakeContext, FakeDiscord
+
+def percentile(values, p):
+    values = sorted(values)
+    return(values[min(len(values) - 1, int(p / 100 * len(values)))])
+
+class Workload:
+    """Picks commands (and their arguments) to run against the fake guild."""
+
+    def __init__(self, bot_module, fake, channel, users, mix):
+        self.bot = bot_module
+        self.fake = fake
+        self.channel = channel
+        self.users = users
+        self.mix = mix
+        self.aliases = []
+        self._next_alias = 0
+
+    def seed_messages(self, n):
+        now = datetime.datetime.utcnow()
+        self.seeded = [
+            self.channel.post(
+                random.choice(self.users),
+                f'seed message {i}: ' + ' '.join(random.choices(
+                    ['quote', 'bot', 'this', 'that', 'pin', 'list', 'lol'], k=12)),
+                created_at=now - datetime.timedelta(minutes=n - i)
+            )
+            for i in range(n)
+        ]
+
+    def next_alias(self):
+        self._next_alias += 1
+        return(f'alias {self._next_alias}')
+
+    def pick(self):
+        """Returns `(name, args, kwargs)` for the next command."""
+        name = random.choices([*self.mix], weights=[*self.mix.values()])[0]
+        target = random.choice(self.seeded)
+
+        if name == 'quote':
+            return(name, (), {'request': f'{target.id} a reply'})
+        if name == 'put':
+            alias = self.next_alias()
+            self.aliases.append(alias)
+            return(name, (), {'request': f'{target.id} {alias}'})
+        if name == 'get' and self.aliases:
+            return(name, (), {'alias': random.choice(self.aliases)})
+        if name == 'delete' and self.aliases:
+            return(name, (), {'alias': self.aliases.pop(random.randrange(len(self.aliases)))})
+        if name == 'list':
+            return(name, (), {'request': random.choice(['', 'alias 1'])})
+        if name == 'misquote':
+            return(name, (random.choice(self.users),), {})
+        # get/delete with nothing pinned yet
+        return('quote', (), {'request': f'{target.id}'})
+
+    async def run(self, name, args, kwargs):
+        command = self.bot.bot.get_command(name)
+        requester = random.choice(self.users)
+        message = self.channel.post(requester, f'!{name}')
+        ctx = FakeContext(self.bot.bot, message, command)
+
+        await command.call_before_hooks(ctx)
+        await command.callback(ctx, *args, **kwargs)
+
+async def drive(workload, rate, duration):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    tasks = []
+
+    async def one(name, args, kwargs):
+        start = time.perf_counter()
+        try:
+            await workload.run(name, args, kwargs)
+        except Exception as e:
+            errors[f'{name}: {type(e).__name__}: {e}'] += 1
+            return
+        latencies[name].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        tasks.append(asyncio.ensure_future(one(*workload.pick())))
+        await asyncio.sleep(random.expovariate(rate))
+    await asyncio.gather(*tasks)
+
+    return(latencies, errors, time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=20, help='commands per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds per Discord API call')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='requests per second per route')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--mix', default='quote=5,get=3,put=1,list=1,delete=1,misquote=1')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # Offline: no S3 bucket (so no backups), and a throwaway database
+    # (the bot opens it relative to the working directory)
+    tmp = tempfile.mkdtemp()
+    os.environ.update({
+        'DISCORD_QUOTEBOT_BUCKET': '',
+        'DISCORD_QUOTEBOT_DB_FILENAME': os.path.relpath(os.path.join(tmp, 'pins.db'),
+                                                        BOT_DIR),
+        'DISCORD_QUOTEBOT_LOG_LEVEL': os.environ.get('DISCORD_QUOTEBOT_LOG_LEVEL', 'WARNING'),
+        'DISCORD_QUOTEBOT_METRICS_PORT': '0',
+    })
+    os.chdir(BOT_DIR)
+
+    import discord_quote as bot_module
+
+    fake = FakeDiscord(latency=args.latency,
+                       rate_limit=args.rate_limit,
+                       error_rate=args.error_rate)
+    fake.attach(bot_module.bot)
+    guild = fake.guild('load test')
+    channel = guild.channel('general')
+    users = [fake.user(f'user{i}') for i in range(20)]
+
+    mix = {name: float(weight) for name, weight in
+           (item.split('=') for item in args.mix.split(','))}
+    workload = Workload(bot_module, fake, channel, users, mix)
+    workload.seed_messages(args.messages)
+
+    async def run():
+        await asyncio.wrap_future(bot_module.db_ready)
+        return(await drive(workload, args.rate, args.duration))
+
+    loop = asyncio.get_event_loop()
+    latencies, errors, elapsed = loop.run_until_complete(run())
+
+    completed = sum(len(values) for values in latencies.values())
+    print(f"{completed} commands in {elapsed:.1f}s: {completed / elapsed:.1f}/s "
+          f"(target {args.rate}/s), {sum(errors.values())} errors")
+    print(f"{'command':<10} {'count':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, values in sorted(latencies.items()):
+        print(f"{name:<10} {len(values):>6} {percentile(values, 50) * 1e3:>9.1f} "
+              f"{percentile(values, 99) * 1e3:>9.1f} {max(values) * 1e3:>9.1f}")
+
+    print(f"\nDiscord API: {sum(fake.requests.values())} requests, "
+          f"{fake.rate_limited} rate limited, {fake.errors} server errors")
+    for route, count in fake.requests.most_common():
+        print(f"  {count:>6}  {route}")
+
+    if errors:
+        print('\nerrors:')
+        for error, count in errors.most_common(10):
+            print(f"  {count:>6}  {error}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""A directory-backed stand-in for the parts of a boto3 S3 `Bucket` the bot
+uses, for benchmarks and local runs without AWS credentials.
+"""
+import os
+import shutil
+from types import SimpleNamespace
+
+class LocalBucket:
+
+    def __init__(self, root):
+        self.root = root
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self.objects = SimpleNamespace(filter=self._filter)
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return(os.path.join(self.root, key))
+
+    def upload_file(self, filename, key, ExtraArgs=None):
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        shutil.copyfile(filename, self._path(key))
+        self.bytes_uploaded += os.path.getsize(filename)
+
+    def download_file(self, key, filename, Config=None):
+        if not os.path.exists(self._path(key)):
+            raise FileNotFoundError(key)
+        shutil.copyfile(self._path(key), filename)
+        self.bytes_downloaded += os.path.getsize(filename)
+
+    def delete_objects(self, Delete):
+        for obj in Delete['Objects']:
+            os.remove(self._path(obj['Key']))
+
+    def _filter(self, Prefix=''):
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    yield SimpleNamespace(key=key, size=os.path.getsize(path))
@@ -0,0 +1,361 @@
+"""Micro-benchmarks for the bot's pure functions, with stored baselines.
+
+Covers `utils` (`log_msg`, `parse_msg_url`, `chunk_lines`,
+`text_preprocess`), `render` (block quoting and quote rendering, for
+synthetic messages of a few sizes), the legacy string-building paths in
+`discord_quote.py` (`_format_quote`, with its fetches served from the
+message cache, and `_format_quote_plain`; skipped if the bot can't be
+imported) and the author model's `msg_to_input` (skipped without torch).
+
+Every case is timed in `--runs` rounds (all cases once per round, so a
+slow patch on the machine hits them all alike), and reports the median of
+its per-round best times. It fails (exit status 1) if a case's median is
+slower than its baseline by more than `--tolerance` plus the spread the
+baseline itself showed between rounds (ignoring differences under
+`--min-delta` microseconds, which are timer noise). Baselines are only
+comparable on the machine they were recorded on; re-record them with
+`--save` (which uses the same rounds) after an intentional change, or on
+a new machine.
+
+    python benchmarks/suite.py [-k PATTERN] [--runs 5] [--tolerance 0.3]
+                               [--min-delta 0.5] [--save]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import timeit
+from types import SimpleNamespace
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BOT_DIR)
+
+import render
+import utils
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# Message sizes, in lines
+SIZES = (1, 10, 100, 1000)
+
+_CASES = {}
+
+def case(name):
+    """Registers a benchmark. The decorated function does any setup and
+    returns the zero-argument callable to time (or raises `Skip`).
+    """
+    def register(setup):
+        _CASES[name] = setup
+        return(setup)
+    return(register)
+
+class Skip(Exception):
+    pass
+
+def synthetic_message(lines):
+    return('\n'.join(
+        f'line {i}: some *markdown*, a <:emote:123> and punctuation!?'
+        for i in range(lines)
+    ))
+
+def synthetic_chain(lines, responses):
+    now = datetime.datetime(2020, 6, 1, 12)
+    return({
+        'source': {
+            'author': 'someone',
+            'content': synthetic_message(lines),
+            'created_at': (now - datetime.timedelta(days=3)).isoformat(),
+            'jump_url': 'https://discord.com/channels/1/2/3',
+            'guild_id': 1,
+            'channel_id': 2,
+            'channel_name': 'general',
+            'message_id': 3,
+        },
+        'responses': [
+            {'author': f'responder{i}',
+             'text': f'reply {i}',
+             'created_at': (now - datetime.timedelta(hours=i)).isoformat(),
+             'jump_url': f'https://discord.com/channels/1/2/{100 + i}'}
+            for i in range(responses)
+        ],
+    }, now)
+
+# --- utils
+@case('log_msg/5_fields')
+def _():
+    data = ['sent_message', 'quote', 'general', 123456789, 'some text']
+    return(lambda: str(utils.log_msg(data)))
+
+@case('log_msg/long_text')
+def _():
+    data = ['retrieved_quote', 123456789, 'general', 'someone',
+            '2020-06-01 12:00:00', 'requester', synthetic_message(100)]
+    return(lambda: str(utils.log_msg(data)))
+
+@case('log_msg/filtered')
+def _():
+    # A DEBUG message with a long field, on a logger at INFO
+    logger = logging.getLogger('bench_filtered')
+    logger.setLevel(logging.INFO)
+    text = synthetic_message(100)
+    return(lambda: logger.debug(utils.log_msg(['message_cache', 'hit', text])))
+
+@case('parse_msg_url')
+def _():
+    url = 'https://discord.com/channels/106543824188264448/210562031684812811/93107928369762304'
+    return(lambda: utils.parse_msg_url(url))
+
+@case('chunk_lines/1000_lines')
+def _():
+    lines = synthetic_message(1000).split('\n')
+    return(lambda: utils.chunk_lines(lines, header='**Matching pins:**'))
+
+# --- render
+for _lines in SIZES:
+    @case(f'block_format/{_lines}_lines')
+    def _(lines=_lines):
+        message = synthetic_message(lines)
+        return(lambda: render.block_format(message))
+
+    @case(f'webhook_quote/{_lines}_lines')
+    def _(lines=_lines):
+        chain, now = synthetic_chain(lines, 5)
+        return(lambda: render.webhook_quote(chain, now))
+
+    @case(f'plain_quote/{_lines}_lines')
+    def _(lines=_lines):
+        chain, now = synthetic_chain(lines, 5)
+        return(lambda: render.plain_quote(chain, now))
+
+@case('webhook_quote/dynamic')
+def _():
+    chain, now = synthetic_chain(10, 5)
+    return(lambda: render.webhook_quote(chain, now, style='dynamic'))
+
+@case('misquote/10_lines')
+def _():
+    message = synthetic_message(10)
+    return(lambda: render.misquote('someone', 12, message, likelihood=0.42))
+
+@case('text_preprocess/1_lines')
+def _():
+    message = synthetic_message(1)
+    return(lambda: utils.text_preprocess(message))
+
+@case('text_preprocess/10_lines')
+def _():
+    message = synthetic_message(10)
+    return(lambda: utils.text_preprocess(message))
+
+# --- legacy quote formatting (quotes sent before chains were recorded)
+_bot_module = None
+
+def _bot():
+    global _bot_module
+    if _bot_module is None:
+        # Offline: no backups, a throwaway database (opened relative to the
+        # working directory), and quiet logs
+        os.environ.update({
+            'DISCORD_QUOTEBOT_BUCKET': '',
+            'DISCORD_QUOTEBOT_DB_FILENAME': os.path.relpath(
+                os.path.join(tempfile.mkdtemp(), 'pins.db'), BOT_DIR),
+            'DISCORD_QUOTEBOT_METRICS_PORT': '0',
+            'DISCORD_QUOTEBOT_LOG_LEVEL': 'WARNING',
+        })
+        cwd = os.getcwd()
+        os.chdir(BOT_DIR)
+        try:
+            import discord_quote
+        except Exception as e:
+            raise Skip(f'discord_quote unavailable ({type(e).__name__}: {e})')
+        finally:
+            os.chdir(cwd)
+        _bot_module = discord_quote
+    return(_bot_module)
+
+def legacy_requote(depth, lines):
+    """Returns `(ctx, quote, earlier)` for a requote of a `depth`-deep
+    chain whose source is `lines` long, in the pre-chain text format.
+    """
+    now = datetime.datetime(2020, 6, 1, 12)
+    channel = SimpleNamespace(id=2, name='general')
+    guild = SimpleNamespace(id=1, get_channel=lambda channel_id: channel)
+    earlier = []
+    text = [f"**user0 said [3 days ago](<https://discord.com/channels/1/2/1000>):**",
+            render.block_format(synthetic_message(lines))]
+    for level in range(depth + 1):
+        earlier.append(SimpleNamespace(
+            id=1000 + level,
+            created_at=now - datetime.timedelta(hours=depth - level + 2),
+            author=SimpleNamespace(name=f'user{level}'),
+            clean_content=f'reply {level}',
+        ))
+    for level in range(1, depth):
+        text.append(f"**user{level} responded [{depth - level} hours ago]"
+                    f"(<https://discord.com/channels/1/2/{1000 + level}>):** reply {level}")
+    text.append(f"**user{depth} responded:** reply {depth}")
+
+    quote = SimpleNamespace(id=2000,
+                            content='\n'.join(text),
+                            clean_content='\n'.join(text),
+                            created_at=now - datetime.timedelta(minutes=5),
+                            jump_url='https://discord.com/channels/1/2/2000')
+    ctx = SimpleNamespace(
+        channel=channel,
+        guild=guild,
+        message=SimpleNamespace(created_at=now,
+                                channel=channel,
+                                author=SimpleNamespace(name='requoter')),
+    )
+    return(ctx, quote, earlier, channel)
+
+for _depth, _lines in ((1, 1), (10, 10), (10, 100)):
+    @case(f'format_quote/{_depth}_deep_{_lines}_lines')
+    def _(depth=_depth, lines=_lines):
+        bot = _bot()
+        from message_cache import MessageCache
+        ctx, quote, earlier, channel = legacy_requote(depth, lines)
+
+        # Serve the earlier messages from the message cache, so only the
+        # string building is timed
+        bot.messages = MessageCache(maxsize=depth + 10, ttl=1e9)
+        loop = asyncio.new_event_loop()
+        for msg_ in earlier:
+            async def fetch_message(msg_id, msg_=msg_):
+                return(msg_)
+            channel.fetch_message = fetch_message
+            loop.run_until_complete(bot.messages.fetch(channel, msg_.id))
+
+        return(lambda: loop.run_until_complete(bot._format_quote(ctx, quote)))
+
+for _lines in (1, 100):
+    @case(f'format_quote_plain/reply_{_lines}_lines')
+    def _(lines=_lines):
+        bot = _bot()
+        ctx, quote, _, _ = legacy_requote(3, lines)
+        return(lambda: bot._format_quote_plain(ctx, quote, 'a', 'reply'))
+
+    @case(f'format_quote_plain/noreply_{_lines}_lines')
+    def _(lines=_lines):
+        bot = _bot()
+        ctx, quote, _, _ = legacy_requote(3, lines)
+        quote.content += '\n__via someone__'
+        return(lambda: bot._format_quote_plain(ctx, quote))
+
+# --- author model
+def _author_model():
+    try:
+        import author_model
+    except Exception as e:
+        raise Skip(f'author_model unavailable ({type(e).__name__}: {e})')
+    return(author_model)
+
+for _lines in (1, 10):
+    @case(f'msg_to_input/{_lines}_lines')
+    def _(lines=_lines):
+        author_model = _author_model()
+        if author_model._VOCAB is None:
+            raise Skip('author model checkpoint not loaded')
+        message = synthetic_message(lines)
+        return(lambda: author_model.msg_to_input(message, 12, author_model._VOCAB))
+
+def calibrate(fn, min_time=0.05):
+    """Returns a `(timer, number)` pair for `measure()`: `number` calls of
+    `fn` take about `min_time` seconds.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return(timer, max(1, int(number * min_time / 0.2)))
+
+def measure(timer, number, repeat=3):
+    """Returns the best time per call, in seconds."""
+    return(min(timer.repeat(repeat=repeat, number=number)) / number)
+
+def spread(times):
+    """How far the slowest round was from the median, relative to it."""
+    median = statistics.median(times)
+    return(max(times) / median - 1)
+
+def machine():
+    return(f'{platform.system()} {platform.machine()} '
+           f'{os.cpu_count()} cpus python {platform.python_version()}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', default='', help='only run cases containing this')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--tolerance', type=float, default=0.3)
+    parser.add_argument('--min-delta', type=float, default=0.5,
+                        help='microseconds')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baselines')
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+        if baselines.get('_machine') != machine():
+            print(f"note: baselines were recorded on {baselines.get('_machine')}")
+
+    fns = {}
+    for name, setup in _CASES.items():
+        if args.k not in name:
+            continue
+        try:
+            fns[name] = calibrate(setup())
+        except Skip as e:
+            print(f"{name:<38} skipped: {e}")
+
+    rounds = {name: [] for name in fns}
+    for _ in range(max(1, args.runs)):
+        for name, (timer, number) in fns.items():
+            rounds[name].append(measure(timer, number))
+
+    results = {}
+    regressions = []
+    print(f"{'case':<38} {'median':>10} {'spread':>7} {'baseline':>10} {'change':>8}")
+    for name, times in rounds.items():
+        results[name] = {'median': statistics.median(times), 'spread': spread(times)}
+        line = (f"{name:<38} {results[name]['median'] * 1e6:>8.2f}us "
+                f"{results[name]['spread']:>6.0%}")
+
+        baseline = baselines.get('cases', {}).get(name)
+        if isinstance(baseline, dict):
+            change = results[name]['median'] / baseline['median'] - 1
+            allowed = args.tolerance + baseline['spread']
+            regressed = (change > allowed
+                         and (results[name]['median'] - baseline['median']) * 1e6
+                         > args.min_delta)
+            flag = f' REGRESSION (> {allowed:+.0%})' if regressed else ''
+            if regressed:
+                regressions.append(name)
+            print(f"{line} {baseline['median'] * 1e6:>8.2f}us {change:>+7.0%}{flag}")
+        else:
+            print(f"{line} {'-':>10}")
+
+    if args.save:
+        # Keep the baselines of cases that weren't run (recorded in this
+        # format)
+        cases = {name: baseline
+                 for name, baseline in baselines.get('cases', {}).items()
+                 if isinstance(baseline, dict)}
+        cases.update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump({'_machine': machine(), 'runs': args.runs, 'cases': cases}, f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"saved {len(results)} baselines to {BASELINES}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import asyncio
+import io
+import logging
+import tempfile
+import time
+
+import discord
+
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+
+class ForwardedAttachments:
+    """A quoted message's attachments, ready to be re-uploaded.
+
+    `spooled` holds `(filename, spoiler, file)` for the downloaded
+    attachments (each file is an `io.BytesIO` up to the spool threshold,
+    and a named temporary file beyond it), and `links` the urls of the
+    attachments that are linked rather than re-uploaded. Call `close()`
+    once the quote has been sent.
+    """
+
+    def __init__(self, spooled, links, bytes_transferred):
+        self.spooled = spooled
+        self.links = links
+        self.bytes_transferred = bytes_transferred
+
+    def to_files(self):
+        """Returns a fresh list of `discord.File`s (so a failed send can be
+        retried).
+        """
+        files = []
+        for filename, spoiler, fp in self.spooled:
+            if isinstance(fp, io.BytesIO):
+                fp.seek(0)
+                files.append(discord.File(fp, filename=filename, spoiler=spoiler))
+            else:
+                # discord.py only takes `io.IOBase`s or paths, and a
+                # temporary file object isn't an `io.IOBase` (before
+                # Python 3.11), so pass its path; the `discord.File` opens
+                # (and closes) its own handle
+                fp.flush()
+                files.append(discord.File(fp.name, filename=filename, spoiler=spoiler))
+        return(files)
+
+    def links_text(self):
+        """Returns the linked attachments as text to append to a message."""
+        return(''.join(f'\n{url}' for url in self.links))
+
+    def close(self):
+        for _, _, fp in self.spooled:
+            fp.close()
+        self.spooled = []
+
+async def _download(session, attachment, spool_over):
+    # Streams an attachment into memory, moving it to a temporary file
+    # once it's larger than `spool_over` bytes
+    fp = io.BytesIO()
+    try:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(_CHUNK_SIZE):
+                fp.write(chunk)
+                if isinstance(fp, io.BytesIO) and fp.tell() > spool_over:
+                    spilled = tempfile.NamedTemporaryFile()
+                    spilled.write(fp.getvalue())
+                    fp = spilled
+    except BaseException:
+        fp.close()
+        raise
+
+    return(fp)
+
+async def forward_attachments(attachments, session, max_total=8 * 1024 * 1024,
+                              spool_over=1024 * 1024, link_over=8 * 1024 * 1024):
+    """Downloads a message's attachments, concurrently, for re-uploading.
+
+    Attachments larger than `link_over` bytes, and any that would take the
+    total past `max_total` bytes (Discord's upload limit), are linked
+    instead of re-uploaded, as is any attachment that fails to download.
+    Downloads are held in memory up to `spool_over` bytes each, and
+    spooled to temporary files beyond that.
+
+    Returns a `ForwardedAttachments`.
+    """
+    start = time.perf_counter()
+
+    to_download = []
+    links = []
+    total = 0
+    for attachment in attachments:
+        if attachment.size > link_over or total + attachment.size > max_total:
+            links.append(attachment.url)
+        else:
+            to_download.append(attachment)
+            total += attachment.size
+
+    results = await asyncio.gather(
+        *[_download(session, attachment, spool_over) for attachment in to_download],
+        return_exceptions=True
+    )
+
+    spooled = []
+    bytes_transferred = 0
+    for attachment, result in zip(to_download, results):
+        if isinstance(result, Exception):
+            log.warning(log_msg(['attachment_download_failed', attachment.url, result]))
+            links.append(attachment.url)
+            continue
+
+        bytes_transferred += result.tell()
+        spooled.append((attachment.filename, attachment.is_spoiler(), result))
+
+    log.info(log_msg(['attachments_forwarded',
+                      len(spooled),
+                      len(links),
+                      bytes_transferred,
+                      f'{time.perf_counter() - start:.3f}s']))
+
+    return(ForwardedAttachments(spooled, links, bytes_transferred))
@@ -1,17 +1,175 @@
 import torch
-import re
+import os
+import json
+import asyncio
+import logging
+import queue
+import threading
+import time
+import concurrent.futures
+from collections import OrderedDict
 from AuthorNet import AuthorNet
+from utils import log_msg, text_preprocess
+
+log = logging.getLogger(__name__)
 
 _DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-_CHECKPOINT = torch.load("Candidate_1_Adam_06701", map_location=_DEVICE)
-_VOCAB = _CHECKPOINT['vocab']
+CHECKPOINT_PATH = "Candidate_1_Adam_06701"
+# TorchScript export (fc_1 quantized to int8) of the checkpoint (see `export_model.py`)
+OPTIMIZED_PATH = CHECKPOINT_PATH + ".opt.pt"
+
+# Loaded by `load()`, on first use
+_NET = None
+_VOCAB = None
+# The files (and their modification times and sizes) the model was
+# loaded from
+_MODEL_VERSION = None
+_MODEL_PATHS = (CHECKPOINT_PATH, OPTIMIZED_PATH)
+_load_lock = threading.Lock()
+
+class Vocab:
+    """The part of a torchtext vocab that `msg_to_input()` uses, rebuilt
+    from the word list stored with an optimized model.
+    """
+
+    def __init__(self, itos):
+        self.itos = itos
+        self.stoi = {word: i for i, word in enumerate(itos)}
+
+    def __len__(self):
+        return(len(self.itos))
+
+def load_optimized(path=OPTIMIZED_PATH):
+    """Returns `(net, vocab)` for the optimized model at `path`."""
+    # torch 1.5 only takes an `ExtraFilesMap` here, not a dict
+    extra_files = torch._C.ExtraFilesMap()
+    extra_files['vocab.json'] = ''
+    net = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    net.eval()
+    return(net, Vocab(json.loads(extra_files['vocab.json'])))
+
+def _use_optimized(path, optimized_path):
+    # The optimized model only runs on the CPU, and is ignored if the
+    # checkpoint has changed since it was exported
+    if _DEVICE.type != 'cpu' or not os.path.exists(optimized_path):
+        return(False)
+    if os.path.exists(path) and os.path.getmtime(path) > os.path.getmtime(optimized_path):
+        log.warning(log_msg(['author_model', 'optimized_model_stale', optimized_path]))
+        return(False)
+    return(True)
+
+def _source_version(path, optimized_path):
+    return(tuple((p, stat.st_mtime_ns, stat.st_size)
+                 for p in (path, optimized_path) if os.path.exists(p)
+                 for stat in [os.stat(p)]))
+
+def _load_model(path, optimized_path):
+    # Returns `(net, vocab)`
+    if _use_optimized(path, optimized_path):
+        try:
+            model = load_optimized(optimized_path)
+            log.info(log_msg(['author_model', 'loaded', optimized_path, 'cpu']))
+            return(model)
+        except (RuntimeError, OSError, ValueError, KeyError) as e:
+            log.error(log_msg(['author_model', 'optimized_load_failed', optimized_path, e]))
+
+    checkpoint = torch.load(path, map_location=_DEVICE)
+    net = AuthorNet(24, 11, checkpoint['vocab']).to(_DEVICE)
+    net.load_state_dict(checkpoint['model_state'])
+    net.eval()
+    log.info(log_msg(['author_model', 'loaded', path, _DEVICE]))
+    return(net, checkpoint['vocab'])
+
+def load(path=CHECKPOINT_PATH, optimized_path=OPTIMIZED_PATH, force=False):
+    """Loads the model, if that hasn't been done yet (or if `force`): the
+    optimized export at `optimized_path` if there is an up to date one,
+    otherwise the checkpoint at `path`. Cached predictions are dropped
+    whenever a model is loaded. Safe to call from several threads at once.
+    """
+    global _NET, _VOCAB, _MODEL_VERSION, _MODEL_PATHS
+
+    with _load_lock:
+        if _NET is not None and not force:
+            return
+
+        version = _source_version(path, optimized_path)
+        net, vocab = _load_model(path, optimized_path)
+
+        _NET, _VOCAB = net, vocab
+        _MODEL_VERSION = version
+        _MODEL_PATHS = (path, optimized_path)
+        PREDICTIONS.invalidate(version)
+
+def reload_if_changed():
+    """Reloads the model if the files it was loaded from have changed
+    since. Returns whether it did.
+    """
+    if _MODEL_VERSION is None or _source_version(*_MODEL_PATHS) == _MODEL_VERSION:
+        return(False)
+
+    log.info(log_msg(['author_model', 'checkpoint_changed', *_MODEL_PATHS]))
+    load(*_MODEL_PATHS, force=True)
+    return(True)
+
+class PredictionCache:
+    """A bounded LRU cache of the model's softmax outputs (a tuple of
+    probabilities, by label), keyed by `(token ids, hour)`: messages that
+    preprocess to the same tokens share an entry.
+
+    Entries belong to the model `version` they were computed with;
+    `invalidate()` (called whenever a model is loaded) drops them all, and
+    results computed with an older model aren't stored. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._predictions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached probabilities for `key`, or None."""
+        with self._lock:
+            probabilities = self._predictions.get(key)
+            if probabilities is None:
+                self.misses += 1
+                return(None)
+            self._predictions.move_to_end(key)
+            self.hits += 1
+            return(probabilities)
 
-_NET = AuthorNet(24, 11, _VOCAB).to(_DEVICE)
-_NET.load_state_dict(_CHECKPOINT['model_state'])
+    def put(self, key, probabilities, version):
+        with self._lock:
+            if version != self.version or self.maxsize <= 0:
+                return
+            self._predictions[key] = probabilities
+            self._predictions.move_to_end(key)
+            while len(self._predictions) > self.maxsize:
+                self._predictions.popitem(last=False)
+
+    def invalidate(self, version=None):
+        """Drops every entry, and only accepts entries for `version` from
+        now on.
+        """
+        with self._lock:
+            self._predictions.clear()
+            self.version = version
+        log.debug(log_msg(['prediction_cache', 'invalidate']))
+
+    def stats(self):
+        """Returns `(hits, misses, size)`."""
+        return(self.hits, self.misses, len(self._predictions))
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return(self.hits / total if total else 0.0)
+
+PREDICTIONS = PredictionCache()
 
-_NET.eval()
-  
 _AUTHOR_DICT = {0: 106923035595948032,
                 1: 106543824188264448,
                 2: 93107928369762304,
@@ -24,20 +182,6 @@ _AUTHOR_DICT = {0: 106923035595948032,
                 9: 113083395667464192,
                 10: 106967980818042880}
 
-def text_preprocess(msg_text):
-
-    # Remove emotes
-    msg = re.sub(r"([\<]).*?([\>])", "", msg_text).strip()
-
-    # Pad punctuation with spaces
-    msg = re.sub(r"([,.!?\(\)\[\]\{\}:;])", r" \1 ", msg)
-
-    # Remove some markdown characters
-    msg = re.sub(r"([`_*])", r"", msg)
-
-    # lower case
-    return msg.lower()
-
 def msg_to_input(msg_text, hour, vocab):
     
     # One Hot Encoding of Hour
@@ -46,24 +190,50 @@ def msg_to_input(msg_text, hour, vocab):
     
     non_text_tensor = torch.tensor(hour_one_hot).float()
 
+    token_idx = encode(msg_text, vocab)
+
+    return {'text': torch.tensor(token_idx, dtype = torch.long),
+            'nontext': non_text_tensor}
+
+def encode(msg_text, vocab):
+    """Returns the token ids of `msg_text`."""
+
     # Preprocess text
     msg_text = text_preprocess(msg_text)
 
     # Tokenize Message
     tokens = msg_text.split()
-    token_idx = [vocab.stoi[word]
-                if word in vocab.stoi 
-                else vocab.stoi["<unk>"]
-                for word in tokens]
-
-    return {'text': torch.tensor(token_idx, dtype = torch.long),
-            'nontext': non_text_tensor}
+    return [vocab.stoi[word]
+            if word in vocab.stoi
+            else vocab.stoi["<unk>"]
+            for word in tokens]
 
 def label_to_author_id(label, dict=_AUTHOR_DICT):
     return dict[label]
 
 
-def get_best_author_id(msg_text, hour, net=_NET, vocab=_VOCAB, device = _DEVICE):
+def best_author(probabilities):
+    """Returns `(author_id, likelihood)` for the most likely author."""
+    label = max(range(len(probabilities)), key=probabilities.__getitem__)
+    return(label_to_author_id(label), probabilities[label])
+
+def author_probabilities(msg_text, hour):
+    """Returns `{author_id: probability}` for `msg_text` (sent at `hour`),
+    from the prediction cache if possible.
+    """
+    probabilities = predict_probabilities([(msg_text, hour)])[0]
+    if isinstance(probabilities, Exception):
+        raise probabilities
+    return({label_to_author_id(label): p for label, p in enumerate(probabilities)})
+
+def get_best_author_id(msg_text, hour, net=None, vocab=None, device = _DEVICE):
+
+    # The loaded model's predictions are cached
+    if net is None:
+        probabilities = predict_probabilities([(msg_text, hour)])[0]
+        if isinstance(probabilities, Exception):
+            raise probabilities
+        return best_author(probabilities)
 
     with torch.no_grad():
 
@@ -77,7 +247,7 @@ def get_best_author_id(msg_text, hour, net=_NET, vocab=_VOCAB, device = _DEVICE)
         raw_out = net(text, nontext).squeeze()
         output = torch.nn.functional.softmax(raw_out)
 
-        print(raw_out)
+        log.debug(log_msg(['author_model', 'raw_out', raw_out.tolist()]))
 
         predicted_value, predicted_label = output.max(0)
 
@@ -85,6 +255,237 @@ def get_best_author_id(msg_text, hour, net=_NET, vocab=_VOCAB, device = _DEVICE)
 
     return author_id, predicted_value.item()
 
+def _pad_index(vocab):
+    return(vocab.stoi['<pad>'] if '<pad>' in vocab.stoi else vocab.stoi['<unk>'])
+
+def _length_groups(inputs, max_pad):
+    # Indices of `inputs`, grouped by length: each group's lengths are at
+    # most `max_pad` apart, and its first input is its shortest
+    order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]['text']))
+    groups = []
+    for i in order:
+        if (groups
+            and len(inputs[i]['text']) - len(inputs[groups[-1][0]]['text']) <= max_pad):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return(groups)
+
+def predict_batch(inputs, net=None, vocab=None, device=_DEVICE, max_pad=0):
+    """Runs the network on several `msg_to_input()` inputs at once.
+
+    Inputs are grouped by length, and each group is run as one batch.
+    Inputs whose lengths differ by at most `max_pad` tokens share a batch,
+    the shorter ones padded; padding changes the network's output a
+    little, so with the default of 0 only equal-length inputs are batched
+    together, and the results match `get_best_author_id()` exactly.
+
+    Returns a list with, for each input, either its softmax output (a
+    tensor over the authors) or the exception raised while running its
+    group.
+    """
+    if net is None:
+        load()
+        net, vocab = _NET, _VOCAB
+
+    groups = _length_groups(inputs, max_pad)
+
+    results = [None] * len(inputs)
+    with torch.no_grad():
+        net.eval()
+        for group in groups:
+            try:
+                text = torch.nn.utils.rnn.pad_sequence(
+                    [inputs[i]['text'] for i in group],
+                    batch_first=True,
+                    padding_value=_pad_index(vocab)
+                ).to(device)
+                nontext = torch.stack([inputs[i]['nontext'] for i in group]).to(device)
+
+                output = torch.nn.functional.softmax(net(text, nontext), dim=1)
+                for i, row in zip(group, output):
+                    results[i] = row
+            except Exception as e:
+                for i in group:
+                    results[i] = e
+
+    return(results)
+
+def predict_probabilities(requests, max_pad=0):
+    """Returns the softmax output of the loaded model, as a tuple of
+    probabilities by label, for each `(msg_text, hour)` in `requests`
+    (or the exception raised predicting it).
+
+    Cached predictions are reused (see `PREDICTIONS`); the rest, with
+    repeated messages predicted once, go through `predict_batch()`. Only
+    outputs that weren't padded (see `max_pad`) are cached: a padded one
+    depends on the other messages it was batched with.
+    """
+    load()
+    net, vocab, version = _NET, _VOCAB, _MODEL_VERSION
+
+    results = [None] * len(requests)
+    missing = OrderedDict()
+    for i, (msg_text, hour) in enumerate(requests):
+        try:
+            key = (tuple(encode(msg_text, vocab)), hour)
+        except Exception as e:
+            results[i] = e
+            continue
+
+        probabilities = PREDICTIONS.get(key)
+        if probabilities is not None:
+            results[i] = probabilities
+        else:
+            missing.setdefault(key, []).append(i)
+
+    inputs = []
+    for (token_idx, hour) in missing:
+        hour_one_hot = [0]*24
+        hour_one_hot[hour] = 1
+        inputs.append({'text': torch.tensor(token_idx, dtype = torch.long),
+                       'nontext': torch.tensor(hour_one_hot).float()})
+
+    # The inputs that are as long as the longest of their batch
+    unpadded = set()
+    for group in _length_groups(inputs, max_pad):
+        longest = len(inputs[group[-1]]['text'])
+        unpadded.update(i for i in group if len(inputs[i]['text']) == longest)
+
+    outputs = predict_batch(inputs, net=net, vocab=vocab, max_pad=max_pad)
+    for n, ((key, indices), output) in enumerate(zip(missing.items(), outputs)):
+        if not isinstance(output, Exception):
+            output = tuple(output.tolist())
+            if n in unpadded:
+                PREDICTIONS.put(key, output, version)
+        for i in indices:
+            results[i] = output
+
+    return(results)
+
+class InferenceService:
+    """Runs author predictions in a dedicated worker thread, in small
+    batches.
+
+    `submit()` queues a message. The worker waits up to `window` seconds
+    after the first queued message for more to arrive (up to
+    `max_batch`), runs them through `predict_probabilities()` together,
+    and resolves each request's future with its probabilities. From a
+    coroutine, use `predict()` for `(author_id, likelihood)` or
+    `probabilities()` for `{author_id: probability}`.
+
+    Messages up to `max_pad` tokens apart in length share a batch (see
+    `predict_batch()`): the padding moves probabilities by a few hundredths
+    at most, for many fewer, fuller batches when lengths vary.
+
+    Every `reload_every` seconds (at most), the worker checks whether the
+    model's files have changed, and reloads it if so.
+
+    `threads` sets `torch.set_num_threads()`, which applies to the whole
+    process, so it also caps any other torch work.
+    """
+
+    def __init__(self, window=0.005, max_batch=32, threads=2, max_pad=4,
+                 reload_every=60):
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.threads = threads
+        self.max_pad = max_pad
+        self.reload_every = reload_every
+        self._checked = time.monotonic()
+        self.batches = 0
+        self.requests = 0
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='author_inference',
+                                            daemon=True)
+            self._thread.start()
+        return(self)
+
+    def close(self):
+        """Finishes the queued requests and stops the worker."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, msg_text, hour):
+        """Queues a prediction. Returns a `concurrent.futures.Future` for
+        the probabilities (by label).
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((msg_text, hour, future))
+        return(future)
+
+    async def predict(self, msg_text, hour):
+        """Returns `(author_id, likelihood)` for the most likely author."""
+        return(best_author(await asyncio.wrap_future(self.submit(msg_text, hour))))
+
+    async def probabilities(self, msg_text, hour):
+        """Returns `{author_id: probability}`."""
+        probabilities = await asyncio.wrap_future(self.submit(msg_text, hour))
+        return({label_to_author_id(label): p for label, p in enumerate(probabilities)})
+
+    def _collect(self):
+        # Blocks for the first request, then gathers more for up to
+        # `window` seconds. Returns the batch, and whether to stop after it
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return([], True)
+
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is None:
+                return(batch, True)
+            batch.append(item)
+
+        return(batch, False)
+
+    def _run(self):
+        torch.set_num_threads(self.threads)
+
+        done = False
+        while not done:
+            batch, done = self._collect()
+            # Drop requests cancelled while queued
+            batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+            try:
+                if batch:
+                    self._process(batch)
+            except Exception as e:
+                log.error(log_msg(['author_model', 'batch_failed', len(batch), e]))
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _process(self, batch):
+        start = time.perf_counter()
+        if time.monotonic() - self._checked > self.reload_every:
+            self._checked = time.monotonic()
+            reload_if_changed()
+
+        results = predict_probabilities([(msg_text, hour) for msg_text, hour, _ in batch],
+                                        max_pad=self.max_pad)
+        for (_, _, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        self.batches += 1
+        self.requests += len(batch)
+        log.debug(log_msg(['author_model', 'batch', len(batch),
+                           f'{time.perf_counter() - start:.4f}s',
+                           *PREDICTIONS.stats()]))
+
 if __name__ == "__main__":
 
     pred_author, pred_likelihood = get_best_author_id(
@@ -0,0 +1,337 @@
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import metrics
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+# Backups are stored in S3 as a compressed base snapshot plus compressed
+# change logs ("deltas") of everything written since:
+#
+#   {key}.base.gz                       gzipped Sqlite3 database
+#   {key}.deltas/{first}-{last}.json.gz gzipped JSON lines, one per change
+#
+# where {first} and {last} are the (zero-padded) changelog sequence numbers
+# the delta covers. The base records the sequence number it is up to date
+# with in its `_backup_state` table, so a restore applies only the deltas
+# after it.
+def base_key(key):
+    return(f'{key}.base.gz')
+
+def delta_prefix(key):
+    return(f'{key}.deltas/')
+
+def delta_key(key, first, last):
+    return(f'{delta_prefix(key)}{first:012d}-{last:012d}.json.gz')
+
+def _delta_range(object_key):
+    match = re.search(r'/([0-9]+)-([0-9]+)\.json\.gz$', object_key)
+    return(int(match.group(1)), int(match.group(2)))
+
+class BackupScheduler:
+    """Backs up the pin database to S3 from a background thread.
+
+    Call `mark_dirty()` after changing the database. The first change starts
+    a `window` second timer, and every change made before it runs is
+    covered by the same upload. Usually that upload is just a small delta
+    of the changes in the database's changelog (see `PinDatabase.changes()`).
+    The first backup after startup, and every `compact_after` deltas after
+    that, is instead a compressed consistent snapshot of the whole database
+    (see `PinDatabase.snapshot()`), which replaces the deltas before it.
+    If an upload fails, it is retried after another window.
+
+    Call `flush()` on shutdown to upload anything still pending.
+
+    `bucket` only needs the `upload_file()`, `objects.filter()` and
+    `delete_objects()` methods of a boto3 `Bucket`, so a local stand-in
+    works too.
+    """
+
+    def __init__(self, db, bucket, key, window=30.0, compact_after=50):
+        self.db = db
+        self.bucket = bucket
+        self.key = key
+        self.window = window
+        self.compact_after = compact_after
+
+        # None forces a full snapshot on the first backup
+        self._deltas_since_base = None
+
+        self._cond = threading.Condition()
+        self._dirty_since = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='db_backup',
+                                        daemon=True)
+        self._thread.start()
+
+    def mark_dirty(self):
+        """Schedules a backup (if one isn't already scheduled). Safe to call
+        from the event loop: never blocks on the upload.
+        """
+        with self._cond:
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+                self._cond.notify()
+
+    def flush(self):
+        """Stops the background thread and, if there are changes that
+        haven't been uploaded yet, uploads them now (blocking).
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+        with self._cond:
+            pending = self._dirty_since is not None
+            self._dirty_since = None
+
+        if pending:
+            self._backup()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._dirty_since is None and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+                # Let changes accumulate until the window has passed
+                deadline = self._dirty_since + self.window
+                while not self._stopped and time.monotonic() < deadline:
+                    self._cond.wait(deadline - time.monotonic())
+
+                if self._stopped:
+                    return
+                self._dirty_since = None
+
+            if not self._backup():
+                self.mark_dirty()
+
+    def _backup(self):
+        base = (self._deltas_since_base is None
+                or self._deltas_since_base >= self.compact_after)
+        kind = 'base' if base else 'delta'
+
+        start = time.perf_counter()
+        try:
+            if base:
+                self._upload_base()
+            else:
+                self._upload_delta()
+        except Exception as e:
+            log.error(log_msg(['db_backup', 'upload', 'failed', e]))
+            metrics.BACKUP_SECONDS.observe(time.perf_counter() - start,
+                                           kind=kind, outcome='failed')
+            return(False)
+
+        metrics.BACKUP_SECONDS.observe(time.perf_counter() - start,
+                                       kind=kind, outcome='ok')
+        return(True)
+
+    def _upload_delta(self):
+        changes = self.db.changes()
+        if not changes:
+            return
+
+        first, last = changes[0][0], changes[-1][0]
+        start = time.perf_counter()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            delta = os.path.join(tmp, 'delta.json.gz')
+            with gzip.open(delta, 'wt', encoding='utf-8') as f:
+                for seq, query, params in changes:
+                    f.write(json.dumps({'seq': seq,
+                                        'query': query,
+                                        'params': params}) + '\n')
+
+            size = os.path.getsize(delta)
+            self.bucket.upload_file(delta, delta_key(self.key, first, last))
+            metrics.BACKUP_BYTES.inc(size, kind='delta')
+
+        self.db.discard_changes(last)
+        self._deltas_since_base += 1
+
+        log.info(log_msg(['db_backup',
+                          'upload_delta',
+                          'successful',
+                          len(changes),
+                          size,
+                          f'{size / len(changes):.0f} bytes/change',
+                          f'{time.perf_counter() - start:.3f}s']))
+
+    def _upload_base(self):
+        start = time.perf_counter()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshot = os.path.join(tmp, 'snapshot.db')
+            seq = self.db.snapshot(snapshot)
+
+            # The changelog is already reflected in the snapshot
+            conn = sqlite3.connect(snapshot, isolation_level=None)
+            try:
+                conn.execute("PRAGMA journal_mode=DELETE")
+                conn.execute("DELETE FROM _changelog")
+                conn.execute(
+                    "INSERT OR REPLACE INTO _backup_state VALUES ('base_seq', ?)",
+                    (seq,)
+                )
+                conn.execute("VACUUM")
+            finally:
+                conn.close()
+
+            base = os.path.join(tmp, 'snapshot.db.gz')
+            with open(snapshot, 'rb') as f_in, gzip.open(base, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out)
+
+            size = os.path.getsize(base)
+            self.bucket.upload_file(base, base_key(self.key))
+            metrics.BACKUP_BYTES.inc(size, kind='base')
+
+        self.db.discard_changes(seq)
+        self._deltas_since_base = 0
+
+        # Deltas the new base covers are no longer needed
+        stale = [{'Key': obj.key}
+                 for obj in self.bucket.objects.filter(Prefix=delta_prefix(self.key))
+                 if _delta_range(obj.key)[1] <= seq]
+        if stale:
+            self.bucket.delete_objects(Delete={'Objects': stale})
+
+        log.info(log_msg(['db_backup',
+                          'upload_base',
+                          'successful',
+                          size,
+                          len(stale),
+                          f'{time.perf_counter() - start:.3f}s']))
+
+class RestoreError(Exception):
+    """Raised when a downloaded backup fails verification."""
+    pass
+
+def _verify(path):
+    # gzip has already checked the CRC of everything we decompressed; this
+    # checks the database itself.
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchall()
+    except sqlite3.DatabaseError as e:
+        raise RestoreError(f'{path} is not a valid database: {e}')
+    finally:
+        conn.close()
+
+    if result != [('ok',)]:
+        raise RestoreError(f'{path} failed integrity check: {result[:5]}')
+
+def restore(bucket, key, path, transfer_config=None):
+    """Rebuilds the database at `path` from the base snapshot and deltas
+    in S3. Falls back to downloading a plain (non-incremental) backup
+    stored at `key`, if there is no base snapshot.
+
+    The database is rebuilt in a temporary file next to `path`, verified
+    (gzip CRCs and `PRAGMA integrity_check`), and only then moved into
+    place, so `path` is never left half-written. `transfer_config` (a
+    boto3 `TransferConfig`) controls how the downloads are split into
+    parallel ranged requests.
+
+    Returns True if anything was restored. Raises `RestoreError` if the
+    backup fails verification.
+    """
+    start = time.perf_counter()
+    keys = sorted(obj.key for obj in bucket.objects.filter(Prefix=key))
+
+    if base_key(key) not in keys and key not in keys:
+        return(False)
+
+    fd, restored = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        suffix='.restore'
+    )
+    os.close(fd)
+    try:
+        if base_key(key) in keys:
+            deltas = [k for k in keys if k.startswith(delta_prefix(key))]
+            applied = _restore_incremental(bucket, key, deltas, restored,
+                                           transfer_config)
+            mode = 'incremental'
+        else:
+            deltas, applied = [], 0
+            bucket.download_file(key, restored, Config=transfer_config)
+            mode = 'full'
+
+        _verify(restored)
+        os.replace(restored, path)
+    except BaseException:
+        os.remove(restored)
+        metrics.BACKUP_SECONDS.observe(time.perf_counter() - start,
+                                       kind='restore', outcome='failed')
+        raise
+
+    metrics.BACKUP_SECONDS.observe(time.perf_counter() - start,
+                                   kind='restore', outcome='ok')
+    metrics.BACKUP_BYTES.inc(os.path.getsize(path), kind='restore')
+
+    log.info(log_msg(['db_restore',
+                      mode,
+                      'successful',
+                      len(deltas),
+                      applied,
+                      os.path.getsize(path),
+                      f'{time.perf_counter() - start:.3f}s']))
+    return(True)
+
+def _restore_incremental(bucket, key, deltas, restored, transfer_config):
+    # Rebuilds the base + deltas into `restored`. Returns the number of
+    # changes applied on top of the base.
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'base.db.gz')
+        bucket.download_file(base_key(key), base, Config=transfer_config)
+
+        with gzip.open(base, 'rb') as f_in, open(restored, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+        conn = sqlite3.connect(restored, isolation_level=None)
+        try:
+            seq = conn.execute(
+                "SELECT value FROM _backup_state WHERE key = 'base_seq'"
+            ).fetchone()[0]
+
+            conn.execute("BEGIN")
+            applied = 0
+            for object_key in deltas:
+                if _delta_range(object_key)[1] <= seq:
+                    continue
+
+                delta = os.path.join(tmp, 'delta.json.gz')
+                bucket.download_file(object_key, delta, Config=transfer_config)
+                with gzip.open(delta, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        change = json.loads(line)
+                        if change['seq'] <= seq:
+                            continue
+                        conn.execute(change['query'], json.loads(change['params']))
+                        seq = change['seq']
+                        applied += 1
+
+            # Keep numbering new changes after the ones already backed up
+            conn.execute("DELETE FROM sqlite_sequence WHERE name = '_changelog'")
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq) VALUES ('_changelog', ?)",
+                (seq,)
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    return(applied)
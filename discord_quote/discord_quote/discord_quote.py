@@ -1,3 +1,7 @@
+import time
+# Startup is timed by phase (see `startup_phase()`), starting with imports
+_startup = time.perf_counter()
+
 import datetime
 import discord
 from discord.ext import commands
@@ -5,122 +9,225 @@ import asyncio
 import json
 import re
 import logging
-import sys
 import os
 import arrow
 import random
 from pathlib import Path
+from collections import OrderedDict
+import atexit
+import concurrent.futures
 import sqlite3
 import boto3
+import boto3.s3.transfer
 import botocore
-
-import author_model as author
-from utils import log_msg, block_format, parse_msg_url
+import aiohttp
+
+from utils import log_msg, parse_msg_url, chunk_lines
+from utils import configure_logging, parse_sample_rates
+from pin_db import PinDatabase, normalize_alias
+import backup
+from message_cache import MessageCache
+from webhook_cache import WebhookCache
+from attachments import forward_attachments
+import quote_chain
+import render
+import metrics
+import profiling
 
 # Configure logging
+# Records are formatted and written by a background thread. Long fields
+# (e.g., quoted message content) are cut to
+# `DISCORD_QUOTEBOT_LOG_FIELD_LIMIT` characters, and
+# `DISCORD_QUOTEBOT_LOG_SAMPLE` (e.g. 'message_cache=10') keeps only one
+# in every n records of the given message types.
 log = logging.getLogger(__name__)
-fmt = logging.Formatter(u'\u241e'.join(['%(asctime)s',
-                                        '%(name)s',
-                                        '%(levelname)s',
-                                        '%(funcName)s',
-                                        '%(message)s']))
-streamInstance = logging.StreamHandler(stream=sys.stdout)
-streamInstance.setFormatter(fmt)
-log.addHandler(streamInstance)
-log.setLevel(logging.DEBUG)
+log_listener = configure_logging(
+    level=os.environ.get('DISCORD_QUOTEBOT_LOG_LEVEL', 'DEBUG').upper(),
+    loggers=[__name__, 'pin_db', 'backup', 'message_cache', 'webhook_cache',
+             'attachments', 'metrics', 'profiling', 'author_model'],
+    field_limit=int(os.environ.get('DISCORD_QUOTEBOT_LOG_FIELD_LIMIT', 300)) or None,
+    sample_rates=parse_sample_rates(os.environ.get('DISCORD_QUOTEBOT_LOG_SAMPLE', ''))
+)
+
+# Startup time, by phase: logged as each phase finishes, and summarized
+# once the bot has logged in. The S3 and database phases run in the
+# background (see `db_startup()`), as does loading the author model.
+STARTUP = {}
+
+def startup_phase(phase, start):
+    """Records that startup phase `phase`, begun at `start`
+    (`time.perf_counter()`), has finished.
+    """
+    STARTUP[phase] = time.perf_counter() - start
+    log.info(log_msg(['startup', phase, f'{STARTUP[phase]:.3f}s']))
+
+startup_phase('imports', _startup)
+_setup_start = time.perf_counter()
 
 # # Load Frame Data json
 # with open('sfv.json', 'r') as f:
 #     moves = json.loads(f.read())
 
 # --- Initialize S3
-# Check to see if we can initialize
-session = boto3.Session()
-bucket = session.resource('s3').Bucket(os.environ['DISCORD_QUOTEBOT_BUCKET'])
+# Set by `s3_init()` (from `db_startup()`), before the database is ready;
+# None if backups are off or S3 is unreachable.
+bucket = None
+
+def s3_init():
+    """Returns the backup bucket (`DISCORD_QUOTEBOT_BUCKET`), checking that
+    we have access to it. Returns None, turning backups off, if no bucket
+    is configured or it can't be accessed.
+    """
+    name = os.environ.get('DISCORD_QUOTEBOT_BUCKET', '')
+    if not name:
+        log.warning(log_msg(['no_bucket', 'backups_disabled']))
+        return(None)
 
-# Check for permissions
-try:
-    if bucket:
-        bucket.load()
-except botocore.exceptions.NoCredentialsError as e:
-    logging.error(log_msg(['No credentials found', e]))
-    session = None
-    bucket = None
-except botocore.exceptions.ClientError as e:
-    logging.error(log_msg(['Bad credentials: could not access bucket', e]))
-    session = None
-    bucket = None
+    start = time.perf_counter()
+    try:
+        s3_bucket = boto3.Session().resource('s3').Bucket(name)
+        s3_bucket.load()
+    except botocore.exceptions.NoCredentialsError as e:
+        log.error(log_msg(['No credentials found', e]))
+        s3_bucket = None
+    except botocore.exceptions.ClientError as e:
+        log.error(log_msg(['Bad credentials: could not access bucket', e]))
+        s3_bucket = None
+    startup_phase('s3', start)
+
+    return(s3_bucket)
 
 # --- Database functions
 def db_load():
     """Checks if a local copy of the Sqlite3 database exist. If not,
-    attempts to download a backup from S3. If there is no backup,
-    then it initializes a new Sqlite3 database.
+    attempts to restore it from the backup (base snapshot + deltas) in S3.
+    If there is no backup, then it initializes a new Sqlite3 database.
+
+    Opens the long-lived connection to the database and tries to create
+    (if it doesn't already exist) the `pins` table.
 
-    Tries to create (if it doesn't already exist) the `pins` table.
+    Returns the `PinDatabase` wrapping the connection.
 
-    Returns the connection to the databse.
+    If the backup exists but can't be downloaded (or fails verification),
+    retries a few times and then raises, rather than starting over with an
+    empty database (which the next backup would then overwrite the real
+    one with).
 
-    Unless absolutely necessary, don't call this directly.
-    Use `db_execute()` instead.
+    Only call this once, at startup (see `db_startup()`). Use `db_fetch()`
+    and `db_write()` for queries.
     """
 
     db_filename = os.environ['DISCORD_QUOTEBOT_DB_FILENAME']
     # Check if the database exists
     if not Path(f'./{db_filename}').exists() and bucket:
         # If missing, attempt to download backup file
-        logging.info(log_msg(['db_backup', 'download', 'attempt']))
+        # Large files are downloaded as parallel ranged requests
+        transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=8
+        )
 
-        try:
-            bucket.download_file(db_filename, db_filename)
-        except botocore.exceptions.ClientError as e:
-            logging.error(log_msg(['db_backup', 'download', 'failed', e]))
+        for attempt in range(1, 4):
+            log.info(log_msg(['db_backup', 'download', 'attempt', attempt]))
 
-        logging.info(log_msg(['db_backup', 'download', 'successful']))
+            try:
+                if backup.restore(bucket, db_filename, f'./{db_filename}',
+                                  transfer_config=transfer_config):
+                    log.info(log_msg(['db_backup', 'download', 'successful']))
+                else:
+                    log.info(log_msg(['db_backup', 'download', 'no_backup']))
+                break
+            except (botocore.exceptions.BotoCoreError,
+                    botocore.exceptions.ClientError,
+                    backup.RestoreError,
+                    OSError) as e:
+                log.error(log_msg(['db_backup', 'download', 'failed', attempt, e]))
+                if attempt == 3:
+                    raise
+                time.sleep(2 ** attempt)
 
     if Path(f'./{db_filename}').exists():
-        logging.info(log_msg(['database_found']))
+        log.info(log_msg(['database_found']))
     else:
-        logging.info(log_msg(['creating_new_database']))
+        log.info(log_msg(['creating_new_database']))
 
-    conn = sqlite3.connect(f'./{db_filename}')
-    c = conn.cursor()
-    c.execute(
-        """
-        CREATE TABLE IF NOT EXISTS pins (
-        alias TEXT, msg_url TEXT, pin_user TEXT, pin_time TEXT
-        )
-        """
-    )
+    # Record changes for incremental backups
+    db = PinDatabase(f'./{db_filename}', changelog=bool(bucket))
+    db.connect()
 
-    return(conn)
+    return(db)
 
-def db_execute(query):
-    """Wrapper to ensure that any queries that are launched at the
-    database are launched inside a database context (i.e., the connection
-    is closed after the query is run).
+async def db_fetch(query, params=()):
+    """Runs a read query against the shared database connection, on the
+    database worker thread (so the event loop isn't blocked).
 
     Returns all the results of the query.
     """
-    # We define this helper function to make sure that the db is closed
-    # after every query. If not, easy way to corrupt the db.
-    with db_load() as conn:
-        c = conn.cursor()
-        c.execute(query)
-        return(c.fetchall())
+    return(await pin_db.fetch(query, params))
 
-def db_backup():
-    """When called, backs up the sqlite database to a pre-specified S3 bucket.
+async def db_write(query, params=()):
+    """Runs a write query against the shared database connection, on the
+    database worker thread. Writes issued close together are committed in
+    a single transaction; each write is rolled back on its own if it fails.
+
+    Returns all the results of the query.
     """
-    logging.info(log_msg(['db_backup', 'upload', 'attempt']))
+    return(await pin_db.write(query, params))
 
-    db_filename = os.environ['DISCORD_QUOTEBOT_DB_FILENAME']
-    bucket.upload_file(
-        f'./{db_filename}',
-        f'{db_filename}'
-    )
+def db_startup():
+    """Connects to S3, restores (if necessary) and opens the database, and
+    starts the backup scheduler. Runs in a background thread, so the bot can connect
+    to Discord while a large backup is still being restored.
+    """
+    global pin_db, backups, bucket
+
+    bucket = s3_init()
 
-    logging.info(log_msg(['db_backup', 'upload', 'successful']))
+    start = time.perf_counter()
+    pin_db = db_load()
+    atexit.register(pin_db.close)
+
+    if bucket:
+        backups = backup.BackupScheduler(
+            pin_db,
+            bucket,
+            os.environ['DISCORD_QUOTEBOT_DB_FILENAME'],
+            window=float(os.environ.get('DISCORD_QUOTEBOT_BACKUP_WINDOW', 30)),
+            compact_after=int(os.environ.get('DISCORD_QUOTEBOT_BACKUP_COMPACT_AFTER', 50))
+        )
+        # Registered after `pin_db.close`, so it runs first
+        atexit.register(backups.flush)
+
+    startup_phase('database', start)
+
+class DatabaseUnavailable(commands.CheckFailure):
+    """Raised (by `wait_for_db()`) to abort a pin command when the database
+    couldn't be loaded. The requester has already been told, so
+    `on_command_error` ignores it.
+    """
+
+async def wait_for_db(ctx):
+    """`before_invoke` hook for the pin commands: waits until the database
+    is ready. If it couldn't be loaded, tells the requester and aborts the
+    command.
+    """
+    try:
+        await asyncio.wrap_future(db_ready)
+    except Exception as e:
+        log.error(log_msg(['db_unavailable', ctx.command, e]))
+        await ctx.send('Pins are unavailable right now.')
+        raise DatabaseUnavailable('Pin database unavailable') from e
+
+def db_backup():
+    """When called, schedules a backup of the sqlite database to a
+    pre-specified S3 bucket. Changes made within
+    `DISCORD_QUOTEBOT_BACKUP_WINDOW` seconds (default 30) of each other
+    are uploaded together, as one compressed delta, from a background
+    thread. Every `DISCORD_QUOTEBOT_BACKUP_COMPACT_AFTER` deltas (default
+    50), a compressed snapshot of the whole database is uploaded instead.
+    """
+    backups.mark_dirty()
 
 # Bot Code Starts Here
 description = '''
@@ -128,13 +235,200 @@ description = '''
             '''
 
 bot = commands.Bot(command_prefix='!', description=description)
-db_load()   # Initialize a new database
+
+# Command latency and Discord API usage, served at
+# http://{DISCORD_QUOTEBOT_METRICS_HOST}:{DISCORD_QUOTEBOT_METRICS_PORT}/metrics
+# (Prometheus text format). Port 0 turns the endpoint off.
+metrics.instrument_bot(bot)
+METRICS_HOST = os.environ.get('DISCORD_QUOTEBOT_METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('DISCORD_QUOTEBOT_METRICS_PORT', 9464))
+_metrics_server = None
+
+# Per-command profiling (see `profiling.CommandProfiler`), turned on with
+# `DISCORD_QUOTEBOT_PROFILE=1` or by the bot owner with `!profile on`
+profiler = profiling.CommandProfiler(
+    os.environ.get('DISCORD_QUOTEBOT_PROFILE_DIR', './profiles'),
+    every=int(os.environ.get('DISCORD_QUOTEBOT_PROFILE_EVERY', 1)),
+    max_files=int(os.environ.get('DISCORD_QUOTEBOT_PROFILE_MAX_FILES', 50)),
+    enabled=os.environ.get('DISCORD_QUOTEBOT_PROFILE', '0') == '1'
+)
+profiling.instrument_bot(bot, profiler)
+
+# Open (or restore, or initialize) the database in the background; the pin
+# commands wait for `db_ready` before running.
+pin_db = None
+backups = None
+db_ready = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix='db_startup'
+).submit(db_startup)
+
+# The author model (torch, and its checkpoint) is only used by `misquote`
+# without a target, so it's loaded in the background: after login, or on
+# first use with `DISCORD_QUOTEBOT_MODEL_WARM=0`.
+# Predictions run on their own thread (`author_model.InferenceService`),
+# batching requests that arrive within `DISCORD_QUOTEBOT_INFERENCE_WINDOW`
+# milliseconds of each other.
+MODEL_WARM = os.environ.get('DISCORD_QUOTEBOT_MODEL_WARM', '1') == '1'
+author = None
+inference = None
+_model_ready = None
+
+def model_startup():
+    """Imports and loads the author model, and starts the inference
+    worker. Runs in a background thread.
+    """
+    global author, inference
+
+    start = time.perf_counter()
+    import author_model
+    author_model.PREDICTIONS.maxsize = int(
+        os.environ.get('DISCORD_QUOTEBOT_PREDICTION_CACHE_SIZE', 4096)
+    )
+    author_model.load()
+    inference = author_model.InferenceService(
+        window=float(os.environ.get('DISCORD_QUOTEBOT_INFERENCE_WINDOW', 5)) / 1000,
+        max_batch=int(os.environ.get('DISCORD_QUOTEBOT_INFERENCE_BATCH', 32)),
+        threads=int(os.environ.get('DISCORD_QUOTEBOT_INFERENCE_THREADS', 2)),
+        max_pad=int(os.environ.get('DISCORD_QUOTEBOT_INFERENCE_MAX_PAD', 4))
+    ).start()
+    author = author_model
+    startup_phase('model', start)
+
+def model_ready():
+    """Returns the future for loading the author model, starting the load
+    if it hasn't been started yet.
+    """
+    global _model_ready
+    if _model_ready is None:
+        _model_ready = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='model_startup'
+        ).submit(model_startup)
+    return(_model_ready)
+
+# Every command resolves messages through `fetch_message()`, so repeated
+# quotes of the same message are served from here.
+messages = MessageCache(
+    maxsize=int(os.environ.get('DISCORD_QUOTEBOT_MESSAGE_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('DISCORD_QUOTEBOT_MESSAGE_CACHE_TTL', 600))
+)
+
+async def fetch_message(channel, msg_id):
+    """Returns the message `msg_id` from `channel`, from the message cache
+    if possible. Raises whatever `channel.fetch_message()` raises.
+    """
+    msg_ = await messages.fetch(channel, msg_id)
+
+    hits, misses, size = messages.stats()
+    log.info(log_msg(['message_cache', hits, misses, size]))
+
+    return(msg_)
+
+# The webhook (and 'Manage Webhooks' permission) for each channel
+webhooks = WebhookCache()
+
+# Quoted attachments are streamed through our own HTTP session. Attachments
+# are re-uploaded up to `DISCORD_QUOTEBOT_ATTACHMENT_BUDGET` bytes in total
+# per quote; beyond that, or if a single attachment is larger than
+# `DISCORD_QUOTEBOT_ATTACHMENT_LINK_OVER` bytes, they are linked instead.
+ATTACHMENT_BUDGET = int(
+    os.environ.get('DISCORD_QUOTEBOT_ATTACHMENT_BUDGET', 8 * 1024 * 1024)
+)
+ATTACHMENT_LINK_OVER = int(
+    os.environ.get('DISCORD_QUOTEBOT_ATTACHMENT_LINK_OVER', 8 * 1024 * 1024)
+)
+ATTACHMENT_SPOOL_OVER = int(
+    os.environ.get('DISCORD_QUOTEBOT_ATTACHMENT_SPOOL_OVER', 1024 * 1024)
+)
+_http_session = None
+
+def http_session():
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession()
+    return(_http_session)
 
 # --- Bot Functions
+@bot.event
+async def on_webhooks_update(channel):
+    # Also sent when we create our own webhook, so check that the cached one
+    # is really gone before forgetting it
+    try:
+        await webhooks.revalidate(channel)
+    except discord.HTTPException as e:
+        log.warning(log_msg(['webhook_revalidate_failed', channel.id, e]))
+        webhooks.invalidate(channel.id)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    webhooks.invalidate_permissions(channel_id=after.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    webhooks.invalidate_permissions(guild_id=after.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    webhooks.invalidate_permissions(guild_id=role.guild.id)
+
+@bot.event
+async def on_member_update(before, after):
+    if after.id == bot.user.id:
+        webhooks.invalidate_permissions(guild_id=after.guild.id)
+
+@bot.event
+async def on_raw_message_edit(payload):
+    messages.invalidate(payload.channel_id, payload.message_id)
+
+@bot.event
+async def on_raw_message_delete(payload):
+    messages.invalidate(payload.channel_id, payload.message_id)
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    for msg_id in payload.message_ids:
+        messages.invalidate(payload.channel_id, msg_id)
+
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(error, DatabaseUnavailable):
+        return
+    if isinstance(error, commands.CommandNotFound):
+        log.info(log_msg(['command_not_found', ctx.message.content]))
+        return
+    if ctx.command is not None and hasattr(ctx.command, 'on_error'):
+        return
+
+    log.error(log_msg(['command_error', ctx.command, error]), exc_info=error)
+
 @bot.event
 async def on_ready():
+    global _snapshot_backfill, _metrics_server
     log.info(log_msg(['login', bot.user.name, bot.user.id]))
 
+    # `on_ready` fires again after reconnects; only report startup once
+    if 'login' not in STARTUP:
+        startup_phase('login', _login_start)
+        log.info(log_msg(['startup', 'ready',
+                          f'{time.perf_counter() - _startup:.3f}s',
+                          *[f'{phase}={seconds:.3f}s'
+                            for phase, seconds in STARTUP.items()]]))
+
+    if MODEL_WARM:
+        model_ready()
+
+    if _metrics_server is None and METRICS_PORT:
+        try:
+            _metrics_server = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            log.error(log_msg(['metrics', 'serve_failed', METRICS_HOST, METRICS_PORT, e]))
+
+    # `on_ready` fires again after reconnects; only backfill once
+    if _snapshot_backfill is None:
+        _snapshot_backfill = bot.loop.create_task(backfill_snapshots())
+        _snapshot_backfill.add_done_callback(_log_backfill_failure)
+
     # Search all visibile channels and send a message letting users know that
     # the bot is online. Only send in text channels that the bot has permission
     # in.
@@ -170,7 +464,7 @@ async def me(ctx, *text : str):
                       ctx.message.channel.name,
                       ' '.join(text)]))
 
-    output = f"_{ctx.message.author.name} { ' '.join(text) }_"
+    output = render.me(ctx.message.author.name, ' '.join(text))
 
     log.info(log_msg(['formatted_self', ' '.join(text)]))
 
@@ -249,7 +543,7 @@ async def quote(ctx, *, request:str):
 
     try:
         # Retrieve the message
-        msg_ = await ctx.guild.get_channel(channel_id).fetch_message(msg_id)
+        msg_ = await fetch_message(ctx.guild.get_channel(channel_id), msg_id)
         log.info(log_msg(['retrieved_quote',
                       msg_id,
                       ctx.guild.get_channel(channel_id).name,
@@ -263,26 +557,48 @@ async def quote(ctx, *, request:str):
 
         # Use WebHooks if possible
         if hook:
-            payload = await webhook_quote(ctx, msg_, *reply)
+            # Download the attachments once; a retry re-sends the same data
+            forwarded = await forward_attachments(
+                msg_.attachments,
+                http_session(),
+                max_total=ATTACHMENT_BUDGET,
+                spool_over=ATTACHMENT_SPOOL_OVER,
+                link_over=ATTACHMENT_LINK_OVER
+            )
+            links = forwarded.links_text()
+
+            # Leave room for the attachment links
+            payload, chain = await webhook_quote(ctx, msg_, *reply,
+                                                 limit=render.LIMIT - len(links))
+
+            async def files():
+                return(forwarded.to_files())
 
             # We retain the output (so we can reference it, if necessary)
-            out = await hook.send(
-                content=payload,
-                username=ctx.guild.me.name,
-                avatar_url=str(ctx.guild.me.avatar_url),
-                files=[await attachment.to_file() for attachment in msg_.attachments],
-                wait=True
-            )
+            try:
+                out = await _hook_send(
+                    ctx,
+                    hook,
+                    files=files,
+                    content=payload + links,
+                    username=ctx.guild.me.name,
+                    avatar_url=str(ctx.guild.me.avatar_url),
+                    wait=True
+                )
+            finally:
+                forwarded.close()
 
             log.info(log_msg(['sent_webhook_message',
                               'quote',
                               ctx.message.channel.name]))
 
+            await _record_quote(ctx, out, chain)
+
         else:
             await bot_quote(ctx, msg_, *reply)
 
     except discord.errors.HTTPException as e:
-        log.warning(['msg_not_found', msg_id, ctx.message.author.mention, e])
+        log.warning(log_msg(['msg_not_found', msg_id, ctx.message.author.mention, e]))
 
         # Return error if message not found.
         await ctx.channel.send(
@@ -304,76 +620,116 @@ async def _get_hook(ctx, channel_id=None):
         channel = ctx.guild.get_channel(channel_id)
 
     # Check for 'Manage WebHook' permission and return if missing permission
-    if not channel.permissions_for(ctx.guild.me).manage_webhooks:
+    if not webhooks.can_manage(channel, ctx.guild.me):
         return
 
-    # Figure out the appropriate webhook
-    hook = None
-    webhooks = await channel.webhooks()
-    if webhooks:
-        # If there's an existing webhook, just use that.
-        hook = webhooks[0]
-        log.info(log_msg(['webhook_found', hook.name]))
-    else:
-        log.info(log_msg(['webhook_not_found']))
-
-        # Otherwise, create a webhook.
-        hook = await channel.create_webhook(name=bot.user.name)
-        log.info(log_msg(['webhook_created', hook.name]))
-
-    return(hook)
-
-async def webhook_quote(ctx, msg_, *reply: str):
-    # This version depends on everything being well quoted (e.g., with jumpurls)
-    # If the message that has been passed is assigned to the bot, then it is a
-    # previous quote.
-    quote = (msg_.author.name == bot.user.name)
-    if not quote:
-        if reply:
-            output = (
-                await _format_message(ctx, msg_, 'said') +
-                f"**{ctx.message.author.name} responded:** {' '.join(reply)}"
-            )
-        if not reply:
-            output = (
-                await _format_message(ctx, msg_, 'said') +
-                f"_via {ctx.message.author.name}_"
-            )
-    elif quote:
+    # Figure out the appropriate webhook (looked up once per channel)
+    return(await webhooks.get(channel, name=bot.user.name))
 
-        if reply:
-            output = (
-                await _format_quote(ctx, msg_) +
-                f"\n**{ctx.message.author.name} responded:** {' '.join(reply)}"
-            )
-        elif not reply:
-            output = await _format_quote(ctx, msg_)
-    else:
-        pass
+async def _hook_send(ctx, hook, files=None, **kwargs):
+    """Sends a message through a webhook. `files`, if given, is a coroutine
+    function returning the files to attach (so they can be re-created for
+    a retry).
 
-    return(output)
+    If the webhook has been deleted since we cached it, gets (or creates)
+    a new one and tries once more.
+    """
+    # Webhook requests don't go through the bot's HTTP client
+    route = '/webhooks/{webhook_id}/{webhook_token}'
+    try:
+        with metrics.track_request('POST', route):
+            return(await hook.send(files=await files() if files else None, **kwargs))
+    except discord.errors.NotFound:
+        log.warning(log_msg(['webhook_not_found', hook.id, hook.channel_id]))
+        webhooks.invalidate(hook.channel_id)
+
+        hook = await _get_hook(ctx, hook.channel_id)
+        if not hook:
+            raise
+        with metrics.track_request('POST', route):
+            return(await hook.send(files=await files() if files else None, **kwargs))
+
+async def webhook_quote(ctx, msg_, *reply: str, limit=render.LIMIT):
+    """Returns `(output, chain)`: the webhook quote of `msg_` (with the
+    reply, if any), and the chain it was rendered from (see `quote_chain`),
+    to record with `_record_quote()` once it has been sent.
+
+    Quotes the bot has recorded are rendered straight from their stored
+    chain. Quotes from before quotes were recorded are reworked from their
+    text instead (see `_format_quote()`), and have no chain (None).
+
+    The output is truncated to `limit` characters.
+    """
+    chain = await _quote_chain(msg_)
+    if chain is not None:
+        chain = quote_chain.respond(chain,
+                                    ctx.message.author.name,
+                                    ' '.join(reply) if reply else None)
+        style = await timestamp_style(ctx.guild.id)
+        return(render.webhook_quote(chain,
+                                    ctx.message.created_at,
+                                    style,
+                                    limit=limit), chain)
+
+    output = await _format_quote(ctx, msg_)
+    if reply:
+        output += "\n" + render.reply_line(ctx.message.author.name, ' '.join(reply))
+
+    return(render.truncate(output, limit), None)
+
+def _db_available():
+    return(db_ready.done() and db_ready.exception() is None)
+
+async def _quote_chain(msg_):
+    """Returns the chain to quote `msg_` with: its recorded chain if it's
+    one of our quotes, or a new chain if it isn't a quote. Returns None
+    for a quote that wasn't recorded (e.g., it predates the `quotes`
+    table, or the database isn't available).
+    """
+    # If the message that has been passed is assigned to the bot, then it is
+    # a previous quote.
+    if msg_.author.name != bot.user.name:
+        return(quote_chain.start(msg_))
 
-# Helper function for WebHook Quote (quoting simple messages)
-async def _format_message(ctx, msg_, action):
-    # Figure out the respective times
-    current_time = arrow.get(ctx.message.created_at)
-    original_message_time = arrow.get(msg_.created_at)
-    relative_time = original_message_time.humanize(current_time)
+    if not _db_available():
+        return
 
-    # Construct the channel jump_url
-    channel_url = (
-            f"https://discord.com/channels/"
-        f"{msg_.guild.id}/{msg_.channel.id}"
+    rows = await db_fetch(
+        "SELECT chain FROM quotes WHERE message_id = ?",
+        (msg_.id,)
     )
+    if rows:
+        log.info(log_msg(['found_quote_chain', msg_.id]))
+        return(quote_chain.loads(rows[0][0]))
 
-    output = (
-        f"**{msg_.author.name} {action} " +
-        f"[{relative_time}](<{msg_.jump_url}>) " +
-        f"in [#{msg_.channel.name}](<{channel_url}>):**\n"+
-        block_format(msg_.clean_content) + "\n"
-    )
+async def _record_quote(ctx, out, chain):
+    """Records the chain behind `out`, a quote we just sent, so it can be
+    requoted without parsing it.
+    """
+    if chain is None or out is None or not _db_available():
+        return
 
-    return(output)
+    chain = quote_chain.seal(chain, out)
+    try:
+        await db_write(
+            """
+            INSERT OR REPLACE INTO quotes
+            (message_id, guild_id, channel_id, chain, quote_time)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (out.id,
+             ctx.guild.id,
+             ctx.channel.id,
+             quote_chain.dumps(chain),
+             out.created_at.isoformat())
+        )
+    except sqlite3.Error as e:
+        log.warning(log_msg(['record_quote_failed', out.id, e]))
+        return
+
+    # Backup the database to S3
+    if bucket:
+        db_backup()
 
 # Helper function for WebHook Quote (quoting quotes)
 async def _format_quote(ctx, msg_):
@@ -385,27 +741,42 @@ async def _format_quote(ctx, msg_):
     current_time = arrow.get(ctx.message.created_at)
 
     # Adjust old relative times
-    # First, identify the old times
+    # First, identify the old times (jump urls may be on discord.com or the
+    # older discordapp.com)
     old_relative_times = re.findall(
         r'(\*\*.*\[(.*)\]\(\<' +
-        r'https:\/\/discordapp\.com\/channels\/[0-9]*\/[0-9]*\/([0-9]*)' +
+        r'https:\/\/discord(?:app)?\.com\/channels\/[0-9]*\/([0-9]*)\/([0-9]*)' +
         r'\>\))',
         output
     )
 
     # Now, re-humanize these times:
     if old_relative_times:
-        log.info(log_msg(['old_relative_times', 'found']))
-        for i in range(len(old_relative_times)):
-            _temp = old_relative_times[i]
-
+        log.info(log_msg(['old_relative_times', 'found', len(old_relative_times)]))
+
+        # Fetch all of the earlier messages at once (each one only once)
+        msg_ids = [*dict.fromkeys(
+            (int(_temp[2]), int(_temp[3])) for _temp in old_relative_times
+        )]
+        old_msgs = dict(zip(msg_ids, await asyncio.gather(
+            *[fetch_message(ctx.guild.get_channel(channel_id) or ctx.channel, msg_id)
+              for channel_id, msg_id in msg_ids],
+            return_exceptions=True
+        )))
+
+        for _temp in old_relative_times:
             # initialize the target (_old_speaker)
             # and the new content (_new_speaker)
             _old_speaker = _temp[0]
             _new_speaker = _temp[0]
 
             # get the associated old message
-            _old_msg = await ctx.channel.fetch_message(_temp[2])
+            _old_msg = old_msgs[(int(_temp[2]), int(_temp[3]))]
+            if isinstance(_old_msg, Exception):
+                # Leave the old time as it was
+                log.warning(log_msg(['retrieve_quote_failed', _temp[3], _old_msg]))
+                continue
+
             log.info(log_msg(['retrieved_quote',
                           _old_msg.id,
                           ctx.message.channel.name,
@@ -446,35 +817,31 @@ async def bot_quote(ctx, msg_, *reply : str):
     # WebHooks' permission, but you have a bot user, then this is what will be
     # used.
 
-    quote = False
-    author = msg_.author.name
-    message_time = msg_.created_at.strftime("%Y-%m-%d %H:%M:%S")
+    chain = await _quote_chain(msg_)
+    if chain is not None:
+        log.info(log_msg(['formatting_quote', 'chain']))
+        chain = quote_chain.respond(chain,
+                                    ctx.message.author.name,
+                                    ' '.join(reply) if reply else None)
+        style = await timestamp_style(ctx.guild.id)
+        output = render.plain_quote(chain, ctx.message.created_at, style)
+    else:
+        output = render.truncate(_format_quote_plain(ctx, msg_, *reply))
+
+    log.info(log_msg(['formatted_quote', ' '.join(reply)]))
+
+    out = await ctx.channel.send(output)
 
-    # If previously quoted, find the original author
-    if msg_.author.name == bot.user.name:
-        quote = True
+    log.info(log_msg(['sent_message', 'quote', ctx.message.channel.name]))
 
-        # Run a regex search for the author name and if you can find it
-        # re-attribute. If you can't find it, it'll just be the bot's name
-        _author = re.search(r"^\*\*(.*)\[(.*)\]\ssaid:\*\*", msg_.clean_content)
-        if _author:
-            author = _author.group(1)
-            log.info(log_msg(['found_original_author', msg_.id, author]))
-            message_time = _author.group(2)
-            log.info(log_msg(['found_original_timestamp', msg_.id, message_time]))
+    await _record_quote(ctx, out, chain)
 
+# Helper function for Bot Quote (quoting quotes that weren't recorded)
+def _format_quote_plain(ctx, msg_, *reply : str):
     clean_content = msg_.clean_content
 
-    # Format output message, handling replies and quotes
-    if not reply and not quote:
-        log.info(log_msg(['formatting_quote', 'noreply|noquote']))
-        # Simplest case, just quoting a non-quotebot message, with no reply
-        output = (
-            f"**{author} [{message_time}] said:** _via " +
-            f"{ctx.message.author.name}_\n" +
-            block_format(clean_content)
-        )
-    elif not reply and quote:
+    # Format output message, handling replies
+    if not reply:
         log.info(log_msg(['formatting_quote', 'noreply|quote']))
 
         # Find the original quoter
@@ -488,7 +855,7 @@ async def bot_quote(ctx, msg_, *reply : str):
         else:
             # If the regex breaks, just forward the old message.
             output = msg_.content
-    elif reply and quote:
+    else:
         log.info(log_msg(['formatting_quote', 'reply|quote']))
 
         # Detect Last Response so we can hyperlink
@@ -509,24 +876,12 @@ async def bot_quote(ctx, msg_, *reply : str):
             f"[{ctx.message.created_at.strftime('%Y-%m-%d %H:%M:%S')}] " +
             f"responded:** {' '.join(reply)}"
         )
-    else:
-        log.info(log_msg(['formatting_quote', 'reply|quote']))
 
-        output = (
-                f"**{author} [{msg_.created_at.strftime('%Y-%m-%d %H:%M:%S')}] " +
-                f"said:** \n" +
-                block_format(clean_content) +
-                "\n" +
-                f"**{ctx.message.author.name} " +
-                f"[{ctx.message.created_at.strftime('%Y-%m-%d %H:%M:%S')}] " +
-                f"responded:** {' '.join(reply)}"
-        )
-
-    log.info(log_msg(['formatted_quote', ' '.join(reply)]))
-
-    await ctx.channel.send(output)
+    return(output)
 
-    log.info(log_msg(['sent_message', 'quote', ctx.message.channel.name]))
+def _log_model_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        log.error(log_msg(['model_unavailable', repr(future.exception())]))
 
 @bot.command()
 async def misquote(ctx , *target : discord.User):
@@ -544,6 +899,11 @@ async def misquote(ctx , *target : discord.User):
             name = target[0].name
         else:
             name = 'a predictively assigned user'
+            # Load the model (if it isn't already) while the requester types.
+            # The load is logged (and its failure retrieved) even if the
+            # requester never replies and nothing awaits it.
+            model = asyncio.wrap_future(model_ready())
+            model.add_done_callback(_log_model_failure)
 
         log.info(log_msg(['received_request',
                         'misquote',
@@ -571,13 +931,25 @@ async def misquote(ctx , *target : discord.User):
 
         # predict author if unspecified
         if len(target) == 1:
-            response = (f"**{name} definitely said {int(fakediff.seconds/60)} minutes ago:** \n" +
-                            block_format(reply.clean_content)
-                        )
+            response = render.misquote(name,
+                                       int(fakediff.seconds/60),
+                                       reply.clean_content)
         else:
             log.info(log_msg(['no_requested_author']))
 
-            user_id, likelihood = author.get_best_author_id(reply.clean_content, faketime.hour)
+            try:
+                await model
+            except Exception:
+                # Logged by `_log_model_failure()`
+                await ctx.message.author.send(
+                    "Can't predict an author right now; try naming one."
+                )
+                return
+
+            with metrics.INFERENCE_SECONDS.time():
+                user_id, likelihood = await inference.predict(reply.clean_content,
+                                                              faketime.hour)
+            log.info(log_msg(['prediction_cache', *author.PREDICTIONS.stats()]))
             user = await bot.fetch_user(user_id)
             name = user.name
 
@@ -586,10 +958,10 @@ async def misquote(ctx , *target : discord.User):
                             user,
                             likelihood]))
 
-            response = (f"**{name} probably *({likelihood*100:.2f}%)* said " +
-                            f"{int(fakediff.seconds/60)} minutes ago:** \n" +
-                            block_format(reply.clean_content)
-                        )
+            response = render.misquote(name,
+                                       int(fakediff.seconds/60),
+                                       reply.clean_content,
+                                       likelihood=likelihood)
 
         await ctx.channel.send(
             response
@@ -612,8 +984,108 @@ async def misquote(ctx , *target : discord.User):
                           'invalid_misquote_request',
                           ctx.message.channel.name]))
 
+@bot.command()
+@commands.is_owner()
+async def profile(ctx, setting:str=''):
+    """Turns per-command profiling `on` or `off`, or shows its status
+    (bot owner only).
+    """
+    setting = setting.lower().strip()
+    if setting in ('on', 'off'):
+        profiler.enabled = (setting == 'on')
+        log.info(log_msg(['profile', setting, ctx.author.name]))
+
+    await ctx.author.send(profiler.status())
+
+# --- Guild settings ---
+# How quotes show times, per guild (set with `!timestamps`):
+#   - 'humanized': e.g., "3 hours ago", as of when the quote was sent
+#   - 'dynamic': Discord timestamp markup (`<t:...:R>`), which each reader's
+#     client renders in their own time zone and keeps up to date
+# Guilds that haven't chosen use `DISCORD_QUOTEBOT_TIMESTAMP_STYLE`.
+TIMESTAMP_STYLES = ('humanized', 'dynamic')
+DEFAULT_TIMESTAMP_STYLE = os.environ.get(
+    'DISCORD_QUOTEBOT_TIMESTAMP_STYLE', 'humanized'
+)
+_timestamp_styles = {}
+
+async def timestamp_style(guild_id):
+    """Returns the timestamp style for a guild (the default if it hasn't
+    chosen one, or the database isn't available).
+    """
+    if guild_id in _timestamp_styles:
+        return(_timestamp_styles[guild_id])
+
+    if not _db_available():
+        return(DEFAULT_TIMESTAMP_STYLE)
+
+    rows = await db_fetch(
+        "SELECT timestamp_style FROM guild_settings WHERE guild_id = ?",
+        (guild_id,)
+    )
+    if rows and rows[0][0] in TIMESTAMP_STYLES:
+        style = rows[0][0]
+    else:
+        style = DEFAULT_TIMESTAMP_STYLE
+
+    _timestamp_styles[guild_id] = style
+    return(style)
+
+@bot.command()
+@commands.before_invoke(wait_for_db)
+async def timestamps(ctx, style:str=''):
+    """Shows, or sets, how quotes in this server show times: `dynamic`
+    (Discord timestamps, always up to date in each reader's time zone) or
+    `humanized` (e.g., "3 hours ago"). Setting it requires the 'Manage
+    Server' permission.
+    """
+    style = style.lower().strip()
+
+    log.info(log_msg(['received_request',
+                      'timestamps',
+                      ctx.message.author.name,
+                      ctx.message.channel.name,
+                      style]))
+
+    if not style:
+        await ctx.channel.send(
+            f"Quotes here show *{await timestamp_style(ctx.guild.id)}* times."
+        )
+        return
+
+    if style not in TIMESTAMP_STYLES:
+        await ctx.channel.send(
+            f"Timestamp style must be one of: {', '.join(TIMESTAMP_STYLES)}"
+        )
+        return
+
+    if not ctx.author.guild_permissions.manage_guild:
+        log.info(log_msg(['timestamps', 'permission_denied', ctx.author.name]))
+        await ctx.channel.send("Changing the timestamp style requires 'Manage Server'.")
+        return
+
+    await db_write(
+        """
+        INSERT OR REPLACE INTO guild_settings (guild_id, timestamp_style)
+        VALUES (?, ?)
+        """,
+        (ctx.guild.id, style)
+    )
+    _timestamp_styles[ctx.guild.id] = style
+
+    log.info(log_msg(['timestamps', 'set', ctx.guild.id, style]))
+
+    # Backup the database to S3
+    if bucket:
+        db_backup()
+
+    await ctx.channel.send(
+        f"Quotes here will show *{style}* times (set by **{ctx.author.name}**)."
+    )
+
 # --- Pin commands ---
 @bot.command(aliases=['p'])
+@commands.before_invoke(wait_for_db)
 async def put(ctx, *, request:str):
     """
     Stores an existing message from the same channel as a pin with an alias.
@@ -687,10 +1159,12 @@ async def put(ctx, *, request:str):
         await ctx.send('Your alias must be <=25 characters.')
         return
 
-    # Check if alias already exists
-    ### MAYBE WE SHOULD JUST SET A PRIMARY KEY IN THE SCHEMA AND HANDLE THE
-    ### SQLITE ERROR
-    aliases = db_execute(f"SELECT alias FROM pins WHERE lower(alias) = \"{alias}\";")
+    # Check if alias already exists (the unique index also rejects
+    # duplicates, but this lets us fail before fetching the message)
+    aliases = await db_fetch(
+            "SELECT alias FROM pins WHERE guild_id = ? AND alias_norm = ?",
+            (ctx.guild.id, normalize_alias(alias))
+    )
     if len(aliases) > 0:
         log.info(log_msg(['sent_message',
                           'invalid_pin_request',
@@ -725,7 +1199,7 @@ async def put(ctx, *, request:str):
 
     try:
         # Retrieve the message
-        msg_ = await ctx.guild.get_channel(channel_id).fetch_message(msg_id)
+        msg_ = await fetch_message(ctx.guild.get_channel(channel_id), msg_id)
         log.info(log_msg(['retrieved_quote',
                       msg_id,
                       ctx.guild.get_channel(channel_id).name,
@@ -734,16 +1208,35 @@ async def put(ctx, *, request:str):
                       ctx.message.author.name,
                       msg_.clean_content]))
 
-        # Store the message
+        # Store the message (and a snapshot of it, for `!list`)
         row = [alias, msg_.jump_url, ctx.message.author.name, ctx.message.created_at]
-        db_execute(
-                f"""INSERT INTO pins VALUES (
-                "{alias}",
-                "{msg_.jump_url}",
-                "{ctx.message.author.name}",
-                "{ctx.message.created_at}"
+        try:
+            await db_write(
+                """
+                INSERT INTO pins
+                (alias, msg_url, pin_user, pin_time, guild_id, alias_norm,
+                channel_id, message_id, msg_author, msg_created_at, preview,
+                attachment_count, snapshot_time)
+                VALUES (:alias, :msg_url, :pin_user, :pin_time, :guild_id,
+                :alias_norm, :channel_id, :message_id, :msg_author,
+                :msg_created_at, :preview, :attachment_count, :snapshot_time)
+                """,
+                {'alias': alias,
+                 'msg_url': msg_.jump_url,
+                 'pin_user': ctx.message.author.name,
+                 'pin_time': str(ctx.message.created_at),
+                 'guild_id': ctx.guild.id,
+                 'alias_norm': normalize_alias(alias),
+                 **_message_snapshot(msg_)}
             )
-            """)
+        except sqlite3.IntegrityError:
+            # Someone else pinned the same alias in the meantime
+            log.info(log_msg(['sent_message',
+                              'invalid_pin_request',
+                              ctx.message.channel.name,
+                              'Alias not unique.']))
+            await ctx.send(f'*{alias}* has already been used as a pin alias')
+            return
         log.info(log_msg(['insert_successful'] + row))
 
         # Backup the database to S3
@@ -761,7 +1254,9 @@ async def put(ctx, *, request:str):
                 f"*{alias}*"
             )
 
-            out = await hook.send(
+            out = await _hook_send(
+                ctx,
+                hook,
                 content=payload,
                 username=ctx.guild.me.name,
                 avatar_url=str(ctx.guild.me.avatar_url),
@@ -784,7 +1279,7 @@ async def put(ctx, *, request:str):
                               ctx.message.channel.name]))
 
     except discord.errors.HTTPException as e:
-        log.warning(['msg_not_found', msg_id, ctx.message.author.mention, e])
+        log.warning(log_msg(['msg_not_found', msg_id, ctx.message.author.mention, e]))
 
         # Return error if message not found.
         await ctx.channel.send(
@@ -797,6 +1292,7 @@ async def put(ctx, *, request:str):
                           ctx.message.channel.name]))
 
 @bot.command(aliases=['g'])
+@commands.before_invoke(wait_for_db)
 async def get(ctx, *, alias:str):
     """Get a pinned message by providing the alias."""
 
@@ -814,8 +1310,9 @@ async def get(ctx, *, alias:str):
     except Exception as e:
         log.warning(log_msg(['delete_request_failed', f'delete \"{alias}\"', e]))
 
-    pin = db_execute(
-            f"SELECT msg_url FROM pins WHERE lower(alias)=\"{alias}\""
+    pin = await db_fetch(
+            "SELECT msg_url FROM pins WHERE guild_id = ? AND alias_norm = ?",
+            (ctx.guild.id, normalize_alias(alias))
     )
 
     if len(pin) > 0:
@@ -839,17 +1336,330 @@ async def get(ctx, *, alias:str):
         await ctx.channel.send(f'*{alias}* not found in pins')
         return
 
+# --- Pin snapshots ---
+# `put` stores a snapshot of the pinned message alongside the pin, so `list`
+# can render previews without fetching every message. Snapshots older than
+# `DISCORD_QUOTEBOT_SNAPSHOT_TTL` days are refreshed in the background.
+SNAPSHOT_TTL = datetime.timedelta(
+    days=float(os.environ.get('DISCORD_QUOTEBOT_SNAPSHOT_TTL', 7))
+)
+_snapshot_refreshes = set()
+_snapshot_backfill = None
+
+def _preview(content):
+    # Grab a 48 character preview
+    # (max 25 character alias + 7 filler characters means max line
+    # length is 80)
+    return(
+        content[0:min(len(content), 48)]
+        .replace('\n', ' ')
+        .replace('\r', ' ')
+        .strip()
+    )
+
+def _message_snapshot(msg_):
+    """Returns the `pins` columns that snapshot the pinned message."""
+    return({
+        'channel_id': msg_.channel.id,
+        'message_id': msg_.id,
+        'msg_author': msg_.author.name,
+        'msg_created_at': str(msg_.created_at),
+        'preview': _preview(msg_.content),
+        'attachment_count': len(msg_.attachments),
+        'snapshot_time': str(datetime.datetime.utcnow()),
+    })
+
+async def _refresh_snapshot(guild_id, channel_id, msg_id):
+    """Fetches a pinned message and stores a fresh snapshot of it on every
+    pin of that message. If the message is gone, stores an empty snapshot
+    (so it isn't retried). If the bot isn't allowed to read it, or its
+    guild or channel isn't in the cache (yet), stores nothing, so it's
+    tried again later (permissions can change, and the cache fills in
+    after login).
+
+    Returns the snapshot, or None if the message couldn't be fetched.
+    """
+    guild = bot.get_guild(guild_id)
+    channel = guild and guild.get_channel(channel_id)
+    if channel is None:
+        log.info(log_msg(['snapshot_deferred', 'pin', guild_id, channel_id, msg_id,
+                          'channel_not_cached' if guild else 'guild_not_cached']))
+        return(None)
+
+    try:
+        msg_ = await fetch_message(channel, msg_id)
+    except discord.errors.Forbidden as e:
+        log.info(log_msg(['snapshot_forbidden', 'pin', channel_id, msg_id, e]))
+        return(None)
+    except discord.errors.NotFound as e:
+        log.info(log_msg(['snapshot_unavailable', 'pin', channel_id, msg_id, e]))
+        await db_write(
+            "UPDATE pins SET preview = NULL, snapshot_time = ? WHERE message_id = ?",
+            (str(datetime.datetime.utcnow()), msg_id)
+        )
+        if bucket:
+            db_backup()
+        return(None)
+
+    log.info(log_msg(['retrieved_message', 'pin', channel_id, msg_id]))
+
+    snapshot = _message_snapshot(msg_)
+    await db_write(
+        """
+        UPDATE pins SET msg_author = :msg_author,
+        msg_created_at = :msg_created_at, preview = :preview,
+        attachment_count = :attachment_count, snapshot_time = :snapshot_time
+        WHERE message_id = :message_id
+        """,
+        snapshot
+    )
+    if bucket:
+        db_backup()
+
+    return(snapshot)
+
+def _schedule_snapshot_refresh(guild_id, channel_id, msg_id):
+    # Refresh a stale snapshot without making the caller wait for it
+    if msg_id in _snapshot_refreshes:
+        return
+    _snapshot_refreshes.add(msg_id)
+
+    async def refresh():
+        try:
+            await _refresh_snapshot(guild_id, channel_id, msg_id)
+        except Exception as e:
+            log.warning(log_msg(['snapshot_refresh_failed', 'pin', msg_id, e]))
+        finally:
+            _snapshot_refreshes.discard(msg_id)
+
+    bot.loop.create_task(refresh())
+
+def _log_backfill_failure(task):
+    # E.g., the database couldn't be loaded
+    if not task.cancelled() and task.exception() is not None:
+        log.error(log_msg(['snapshot_backfill', 'failed', repr(task.exception())]))
+
+async def backfill_snapshots():
+    """Background job: snapshots the pins stored before snapshots existed,
+    fetching at most `DISCORD_QUOTEBOT_BACKFILL_RATE` (default 1) messages
+    per second. A rate of 0 turns it off.
+    """
+    rate = float(os.environ.get('DISCORD_QUOTEBOT_BACKFILL_RATE', 1))
+    if rate <= 0:
+        log.info(log_msg(['snapshot_backfill', 'disabled']))
+        return
+
+    await asyncio.wrap_future(db_ready)
+
+    rows = await db_fetch(
+        """
+        SELECT DISTINCT guild_id, channel_id, message_id FROM pins
+        WHERE snapshot_time IS NULL AND message_id IS NOT NULL
+        """
+    )
+    log.info(log_msg(['snapshot_backfill', 'start', len(rows)]))
+
+    for guild_id, channel_id, msg_id in rows:
+        try:
+            await _refresh_snapshot(guild_id, channel_id, msg_id)
+        except discord.errors.HTTPException as e:
+            # Leave it for the next backfill
+            log.warning(log_msg(['snapshot_backfill', 'failed', msg_id, e]))
+        await asyncio.sleep(1 / rate)
+
+    log.info(log_msg(['snapshot_backfill', 'done', len(rows)]))
+
+async def _fetch_previews(msg_id_tuples):
+    """Fetches (and snapshots) several pinned messages concurrently, at most
+    `DISCORD_QUOTEBOT_PREVIEW_CONCURRENCY` (default 8) at a time, and at
+    most 2 at a time from any one channel (Discord rate limits message
+    fetches per channel). A fetch that takes longer than
+    `DISCORD_QUOTEBOT_PREVIEW_TIMEOUT` seconds (default 3) is given up on.
+
+    Returns a dict of message id to preview (None if there isn't one).
+    """
+    limit = asyncio.Semaphore(
+        int(os.environ.get('DISCORD_QUOTEBOT_PREVIEW_CONCURRENCY', 8))
+    )
+    timeout = float(os.environ.get('DISCORD_QUOTEBOT_PREVIEW_TIMEOUT', 3))
+    channel_limits = {}
+
+    async def fetch(guild_id, channel_id, msg_id):
+        channel_limit = channel_limits.setdefault(channel_id, asyncio.Semaphore(2))
+        async with channel_limit, limit:
+            try:
+                snapshot = await asyncio.wait_for(
+                    _refresh_snapshot(guild_id, channel_id, msg_id),
+                    timeout
+                )
+            except Exception as e:
+                log.error(log_msg(['failed_to_preview', 'pin', msg_id, repr(e)]))
+                return(msg_id, None)
+
+        return(msg_id, snapshot and snapshot['preview'])
+
+    # Pins of the same message only need one fetch
+    unique = {msg_id: (guild_id, channel_id, msg_id)
+              for guild_id, channel_id, msg_id in msg_id_tuples}
+    previews = await asyncio.gather(*[fetch(*ids) for ids in unique.values()])
+
+    return(dict(previews))
+
+# Whether a user is in a guild, for pin commands sent in a DM. Without the
+# members intent the member cache can't tell, and Discord has to be asked;
+# its answers are kept for `DISCORD_QUOTEBOT_MEMBERSHIP_TTL` seconds, for
+# at most `MEMBERSHIP_CACHE_SIZE` (user, guild) pairs, and at most
+# `DISCORD_QUOTEBOT_MEMBER_LOOKUP_CONCURRENCY` lookups run at once.
+MEMBERSHIP_TTL = float(os.environ.get('DISCORD_QUOTEBOT_MEMBERSHIP_TTL', 600))
+MEMBERSHIP_CACHE_SIZE = 4096
+memberships = OrderedDict()
+_member_lookups = None
+
+async def _pin_guild_ids(ctx):
+    """Returns the ids of the guilds whose pins the requester can see: the
+    current guild, or every guild shared with the bot when in a DM.
+    """
+    global _member_lookups
+
+    if ctx.guild:
+        return([ctx.guild.id])
+
+    if _member_lookups is None:
+        _member_lookups = asyncio.Semaphore(
+            int(os.environ.get('DISCORD_QUOTEBOT_MEMBER_LOOKUP_CONCURRENCY', 4))
+        )
+
+    async def is_member(guild):
+        if guild.get_member(ctx.author.id):
+            return(True)
+
+        key = (ctx.author.id, guild.id)
+        cached = memberships.get(key)
+        if cached and time.monotonic() - cached[1] < MEMBERSHIP_TTL:
+            return(cached[0])
+
+        async with _member_lookups:
+            try:
+                await guild.fetch_member(ctx.author.id)
+                member = True
+            except discord.NotFound:
+                member = False
+            except discord.HTTPException as e:
+                # Not cached: ask again next time
+                log.warning(log_msg(['member_lookup_failed', guild.id, ctx.author.id, e]))
+                return(False)
+
+        memberships[key] = (member, time.monotonic())
+        memberships.move_to_end(key)
+        while len(memberships) > MEMBERSHIP_CACHE_SIZE:
+            memberships.popitem(last=False)
+        return(member)
+
+    guilds = ctx.bot.guilds
+    shared = await asyncio.gather(*[is_member(guild) for guild in guilds])
+    return([guild.id for guild, member in zip(guilds, shared) if member])
+
+def _escape_like(text):
+    # Escape the wildcards in user input that is passed to LIKE
+    return(
+        text.replace('\\', '\\\\')
+        .replace('%', '\\%')
+        .replace('_', '\\_')
+    )
+
+NEXT_PAGE = '\N{BLACK RIGHT-POINTING DOUBLE TRIANGLE}'
+
+async def _list_pins_page(guild_ids, request, after, limit):
+    """Returns up to `limit` pins (from the given guilds, whose alias
+    contains `request`) that sort after the `(alias_norm, guild_id)` in
+    `after`, in alias order.
+    """
+    guild_filter = ', '.join('?' * len(guild_ids))
+    params = [*guild_ids]
+
+    search_filter = ''
+    if request != '':
+        search_filter = "AND alias_norm LIKE ? ESCAPE '\\'"
+        params.append('%' + _escape_like(normalize_alias(request)) + '%')
+
+    rows = await db_fetch(
+            f"""
+            SELECT alias, guild_id, channel_id, message_id, preview,
+            snapshot_time, alias_norm FROM pins
+            WHERE guild_id IN ({guild_filter})
+            {search_filter}
+            AND (alias_norm, guild_id) > (?, ?)
+            ORDER BY alias_norm, guild_id
+            LIMIT ?
+            """,
+            (*params, *after, limit)
+    )
+
+    return([{'alias': x[0],
+             'guild_id': x[1],
+             'msg_id_tuple': (x[1], x[2], x[3]),
+             'preview': x[4],
+             'snapshot_time': x[5],
+             'alias_norm': x[6]}
+            for x in rows])
+
+async def _render_pin_lines(matching_aliases, fetch_missing):
+    """Renders one `!list` line (alias and preview) per pin. If
+    `fetch_missing` is set, pins without a snapshot are fetched (see
+    `_fetch_previews()`).
+
+    Returns the lines, and the number of messages fetched.
+    """
+    # Fetch the pinned messages that haven't been snapshotted yet
+    if fetch_missing:
+        live_previews = await _fetch_previews([
+            msg['msg_id_tuple'] for msg in matching_aliases
+            if msg['snapshot_time'] is None and msg['msg_id_tuple'][2]
+        ])
+    else:
+        live_previews = {}
+
+    # Construct aliases with preview
+    lines = []
+    stale_before = str(datetime.datetime.utcnow() - SNAPSHOT_TTL)
+    for msg in matching_aliases:
+        alias = msg['alias']
+        guild_id = msg['msg_id_tuple'][0]
+        channel_id = msg['msg_id_tuple'][1]
+        msg_id = msg['msg_id_tuple'][2]
+        msg_preview = msg['preview']
+
+        if msg['snapshot_time'] is None:
+            msg_preview = live_previews.get(msg_id)
+        elif msg['snapshot_time'] < stale_before:
+            _schedule_snapshot_refresh(guild_id, channel_id, msg_id)
+
+        if msg_preview is not None:
+            lines.append(f"**{alias}** — (*\"{msg_preview}\"*)")
+            log.info(log_msg(['generated_preview', 'pin', channel_id, msg_id]))
+        else:
+            lines.append(f"**{alias}** — (*No preview.*)")
+
+    return(lines, len(live_previews))
+
 @bot.command(aliases=['l'])
+@commands.before_invoke(wait_for_db)
 async def list(ctx, *, request:str=''):
     """Lists all (or all matching) aliases in the pin database
     and direct messages to the requester (along with a preview).
 
-    If called with no request, list all aliases but does not
-    generate a preview for each alias.
+    Previews come from the snapshot stored when the message was pinned.
+    If called with no request, list all aliases but does not fetch
+    messages to generate a preview for pins without a snapshot.
+
+    Results are sent in pages; react to the last message of a page with
+    ⏩ to get the next one.
 
     Also works when direct messaging the bot.
     """
 
+    start = time.perf_counter()
+
     # Normalize the request
     request=request.lower().strip()
 
@@ -865,91 +1675,87 @@ async def list(ctx, *, request:str=''):
     except Exception as e:
         log.warning(log_msg(['delete_request_failed', f'list \"{request}\"', e]))
 
-    _temp = db_execute(
-            f"SELECT * FROM pins"
-    )
-
-    # First element is alias, second element is msg_url
-    try:
-        # Matching logic here, also parse msg_urls for previews
-        if request != '':
-            matching_aliases = [{'alias':x[0], 'msg_id_tuple':parse_msg_url(x[1])}
-                                for x in _temp
-                                if request in x[0].lower()]
-        else:
-            matching_aliases = [{'alias':x[0], 'msg_id_tuple':(None, None, None)}
-                                for x in _temp]
+    # Only list pins from this guild (or, in a DM, from every guild the
+    # requester shares with the bot)
+    guild_ids = await _pin_guild_ids(ctx)
+    page_size = int(os.environ.get('DISCORD_QUOTEBOT_LIST_PAGE_SIZE', 20))
+
+    # Send a page at a time, as soon as it's ready. Pages are read with
+    # keyset pagination: each one starts after the last (alias_norm,
+    # guild_id) of the page before.
+    after = ('', -1)
+    pages = 0
+    n_matches = 0
+    n_live = 0
+    while True:
+        rows = await _list_pins_page(guild_ids, request, after, page_size + 1)
+        more = len(rows) > page_size
+        rows = rows[:page_size]
 
         log.info(log_msg(['parsed_matching_alias_url_request',
                         'pin',
-                        request]))
-    except ValueError as e:
-        matching_aliases=[]
-        log.info(log_msg(['parsed_url_request_failed', msg_target]))
-
-
-    if len(matching_aliases)==0:
-        await ctx.message.author.send(f"No aliases matching *{request}*.")
-
-        log.info(log_msg(['no_matches_sent',
-                          'pin',
-                           request,
-                           ctx.author.name,
-                           len(matching_aliases)]))
-    else:
-        # Construct aliases with preview
-        out = ''
-        for msg in matching_aliases:
-            alias = msg['alias']
-            guild_id = msg['msg_id_tuple'][0]
-            channel_id = msg['msg_id_tuple'][1]
-            msg_id = msg['msg_id_tuple'][2]
-            try:
-                guild = ctx.bot.get_guild(guild_id)
-                channel = guild.get_channel(channel_id)
-
-                # Fetch the pinned message
-                raw_msg = (
-                        await channel.fetch_message(msg_id)
-                )
+                        request,
+                        pages]))
 
-                log.info(log_msg(['retrieved_message', 'pin', channel_id, msg_id]))
-
-                # Grab a 48 character preview
-                # (max 25 character alias + 7 filler characters means max line
-                # length is 80)
-                msg_preview = (
-                    raw_msg
-                    .content[0:min(len(raw_msg.content), 48)]
-                    .replace('\n', ' ')
-                    .replace('\r', ' ')
-                    .strip()
-                )
+        if pages == 0 and len(rows) == 0:
+            await ctx.message.author.send(f"No aliases matching *{request}*.")
 
-                # Append to output
-                out += '\n' + f"**{alias}** — (*\"{msg_preview}\"*)"
+            log.info(log_msg(['no_matches_sent',
+                              'pin',
+                               request,
+                               ctx.author.name,
+                               0]))
+            return
 
-                log.info(log_msg(['generated_preview', 'pin', channel_id, msg_id]))
+        lines, live = await _render_pin_lines(rows, fetch_missing=(request != ''))
+        header = "**All matching aliases:**" if pages == 0 else ''
+        for chunk in chunk_lines(lines, header=header):
+            last_sent = await ctx.message.author.send(chunk)
 
-            except Exception as e:
-                out += '\n' + f"**{alias}** — (*No preview.*)"
-                log.error(log_msg(['failed_to_preview', 'pin', e]))
-                continue
+        pages += 1
+        n_matches += len(rows)
+        n_live += live
 
-        await ctx.message.author.send(
-            "**All matching aliases:**" + out
-        )
-
-        log.info(log_msg(['list_matches_sent',
+        log.info(log_msg(['list_page_sent',
                           'pin',
                           request,
-                           ctx.author.name,
-                           len(matching_aliases)]))
+                          ctx.author.name,
+                          pages,
+                          len(rows),
+                          f'{time.perf_counter() - start:.3f}s']))
+
+        if not more:
+            break
+
+        # Offer the next page
+        after = (rows[-1]['alias_norm'], rows[-1]['guild_id'])
+        await last_sent.add_reaction(NEXT_PAGE)
+
+        def next_page(reaction, user):
+            return(
+                user.id == ctx.author.id
+                and reaction.message.id == last_sent.id
+                and str(reaction.emoji) == NEXT_PAGE
+            )
 
+        try:
+            await bot.wait_for('reaction_add', check=next_page, timeout=60)
+        except asyncio.TimeoutError:
+            break
+
+    log.info(log_msg(['list_matches_sent',
+                      'pin',
+                      request,
+                       ctx.author.name,
+                       n_matches,
+                       pages,
+                       n_live,
+                       f'{time.perf_counter() - start:.3f}s']))
 
     return
 
 @bot.command(aliases=['d'])
+@commands.before_invoke(wait_for_db)
 async def delete(ctx, *, alias:str):
     """Deletes an alias from the set of stored pins.
     """
@@ -968,14 +1774,16 @@ async def delete(ctx, *, alias:str):
         log.warning(log_msg(['delete_request_failed', f'delete \"{alias}\"', e]))
 
     # Check if the alias exists in the pin database
-    pin = db_execute(
-            f"SELECT msg_url FROM pins WHERE lower(alias)=\"{alias}\""
+    pin = await db_fetch(
+            "SELECT msg_url FROM pins WHERE guild_id = ? AND alias_norm = ?",
+            (ctx.guild.id, normalize_alias(alias))
     )
 
     # If it exists, delete it.
     if len(pin) > 0:
-        db_execute(
-            f"DELETE FROM pins WHERE lower(alias)=\"{alias}\""
+        await db_write(
+            "DELETE FROM pins WHERE guild_id = ? AND alias_norm = ?",
+            (ctx.guild.id, normalize_alias(alias))
         )
 
         log.info(log_msg(['deleted_pin',
@@ -1083,6 +1891,9 @@ async def test(ctx):
 
     await ctx.channel.send('|---END TESTING QUOTE FUNCTIONS---|')
 
+startup_phase('setup', _setup_start)
+_login_start = time.perf_counter()
+
 if __name__=='__main__':
     if os.environ['DISCORD_QUOTEBOT_TOKEN']:
         log.info(log_msg(['token_read']))
@@ -0,0 +1,172 @@
+"""Exports the author model checkpoint for CPU inference, and checks it.
+
+Builds three variants of `AuthorNet` from the checkpoint:
+
+- `eager`: the checkpoint as `author_model` loads it (float32, eager)
+- `script`: `bn3` folded into `fc_1`, compiled with TorchScript
+- `int8`: `script`, with `fc_1` dynamically quantized to int8
+
+and reports, for each, its serialized size, its latency on single
+messages, and how closely it agrees with `eager` on a sample of messages
+(the top author, and the largest difference in any author's
+probability). The `int8` variant is then written to
+`author_model.OPTIMIZED_PATH` (with the vocabulary), which
+`author_model.load()` prefers over the checkpoint, unless it agrees with
+`eager` on fewer than `--min-agreement` of the sample.
+
+Only `bn3` is folded. It's an affine map applied right before `fc_1` (the
+reshape in between just repeats each channel's scale and shift over its
+8 pooled positions), so folding it into `fc_1`'s weights and bias is
+exact. `bn1` and `bn2` come after a ReLU and a max pool, so they can't be
+folded back into `conv1`/`conv2`, and folding them forward into
+`conv2`/`conv3` would be wrong at the sequence edges, where those
+convolutions' zero padding would then stand for BN's shift rather than
+zero; they're left in.
+
+`--sample` is a held-out file of messages, one per line as
+`hour<TAB>message`. Without it, a sample is made up from random words of
+the vocabulary, which checks the export but says less about accuracy.
+
+    python export_model.py [--checkpoint PATH] [--out PATH]
+                           [--sample FILE] [--min-agreement 0.99]
+"""
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+import author_model
+from AuthorNet import AuthorNet
+
+def fold_bn3(net):
+    """Folds `net.bn3` (in eval mode) into `net.fc_1`, in place, and
+    replaces it with an identity.
+    """
+    bn = net.bn3
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+
+    fc = net.fc_1
+    pooled = fc.in_features - net.nontext_input_size
+    positions = pooled // bn.num_features
+
+    with torch.no_grad():
+        # Features are laid out channel-major: channel c is features
+        # c * positions ... (c + 1) * positions - 1
+        weight = fc.weight[:, :pooled]
+        fc.bias += weight @ shift.repeat_interleave(positions)
+        weight *= scale.repeat_interleave(positions)
+
+    net.bn3 = nn.Identity()
+    return(net)
+
+def quantize(net):
+    """Returns `net` with its linear layer dynamically quantized to int8.
+
+    torch 1.5 (see `requirements.txt`) only quantizes `nn.Linear` (and
+    LSTMs) dynamically: the embedding and convolutions stay float32.
+    """
+    qconfig_spec = {nn.Linear: torch.quantization.default_dynamic_qconfig}
+    return(torch.quantization.quantize_dynamic(net, qconfig_spec, dtype=torch.qint8))
+
+def serialized_size(net):
+    buffer = io.BytesIO()
+    if isinstance(net, torch.jit.ScriptModule):
+        torch.jit.save(net, buffer)
+    else:
+        torch.save(net.state_dict(), buffer)
+    return(buffer.tell())
+
+def load_sample(path, vocab, n):
+    if path:
+        with open(path) as f:
+            rows = [line.rstrip('\n').split('\t', 1) for line in f if '\t' in line]
+        return([(int(hour), text) for hour, text in rows])
+
+    words = [word for word in vocab.itos if not word.startswith('<')]
+    return([(random.randrange(24),
+             ' '.join(random.choices(words, k=random.randint(3, 30))))
+            for _ in range(n)])
+
+def predict(net, vocab, sample):
+    outputs = []
+    with torch.no_grad():
+        for hour, text in sample:
+            obs = author_model.msg_to_input(text, hour, vocab)
+            raw_out = net(obs['text'].unsqueeze(0), obs['nontext'].unsqueeze(0))
+            outputs.append(torch.nn.functional.softmax(raw_out, dim=1)[0])
+    return(outputs)
+
+def latency(net, vocab, sample, runs=200):
+    inputs = [author_model.msg_to_input(text, hour, vocab) for hour, text in sample[:runs]]
+    times = []
+    with torch.no_grad():
+        for obs in inputs * max(1, runs // len(inputs)):
+            start = time.perf_counter()
+            net(obs['text'].unsqueeze(0), obs['nontext'].unsqueeze(0))
+            times.append(time.perf_counter() - start)
+    return(statistics.median(times))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default=author_model.CHECKPOINT_PATH)
+    parser.add_argument('--out', default=author_model.OPTIMIZED_PATH)
+    parser.add_argument('--sample', default=None)
+    parser.add_argument('--sample-size', type=int, default=1000)
+    parser.add_argument('--min-agreement', type=float, default=0.99)
+    parser.add_argument('--threads', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(0)
+    torch.set_num_threads(args.threads)
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    vocab = checkpoint['vocab']
+    eager = AuthorNet(24, 11, vocab)
+    eager.load_state_dict(checkpoint['model_state'])
+    eager.eval()
+
+    scripted = torch.jit.script(fold_bn3(copy.deepcopy(eager)))
+    int8 = torch.jit.script(quantize(fold_bn3(copy.deepcopy(eager))))
+    variants = {'eager': eager, 'script': scripted, 'int8': int8}
+
+    # Messages with no words left after preprocessing can't be predicted
+    sample = [(hour, text)
+              for hour, text in load_sample(args.sample, vocab, args.sample_size)
+              if author_model.text_preprocess(text).split()]
+    reference = predict(eager, vocab, sample)
+
+    print(f"{len(sample)} sample messages"
+          f"{'' if args.sample else ' (synthetic)'}, {args.threads} thread(s)")
+    print(f"{'variant':<8} {'size MB':>8} {'latency ms':>11} {'agreement':>10} {'max |dp|':>9}")
+    agreement = {}
+    for name, net in variants.items():
+        outputs = predict(net, vocab, sample)
+        agreement[name] = sum(out.argmax().item() == ref.argmax().item()
+                              for out, ref in zip(outputs, reference)) / len(sample)
+        max_diff = max((out - ref).abs().max().item()
+                       for out, ref in zip(outputs, reference))
+        print(f"{name:<8} {serialized_size(net) / 2**20:>8.2f} "
+              f"{latency(net, vocab, sample) * 1e3:>11.3f} "
+              f"{agreement[name]:>10.2%} {max_diff:>9.5f}")
+
+    if agreement['int8'] < args.min_agreement:
+        print(f"int8 agreement {agreement['int8']:.2%} is below "
+              f"{args.min_agreement:.2%}; not writing {args.out}")
+        sys.exit(1)
+
+    # torch 1.5 only takes an `ExtraFilesMap` here, not a dict
+    extra_files = torch._C.ExtraFilesMap()
+    extra_files['vocab.json'] = json.dumps(list(vocab.itos))
+    torch.jit.save(int8, args.out, _extra_files=extra_files)
+    print(f"wrote {args.out} ({os.path.getsize(args.out) / 2**20:.2f} MB)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+class MessageCache:
+    """A bounded LRU cache of fetched Discord messages, keyed by
+    `(channel_id, message_id)`.
+
+    Entries expire after `ttl` seconds, and the least recently used entry
+    is evicted once there are more than `maxsize`. Call `invalidate()` when
+    a message is edited or deleted. Concurrent fetches of the same message
+    share a single request.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._messages = OrderedDict()
+        self._pending = {}
+
+    async def fetch(self, channel, msg_id):
+        """Returns the message `msg_id` from `channel`, from the cache if
+        possible. Raises whatever `channel.fetch_message()` raises.
+        """
+        key = (channel.id, int(msg_id))
+
+        entry = self._messages.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._messages.move_to_end(key)
+            self.hits += 1
+            log.debug(log_msg(['message_cache', 'hit', *key, self.hits, self.misses]))
+            return(entry[0])
+
+        self.misses += 1
+        log.debug(log_msg(['message_cache', 'miss', *key, self.hits, self.misses]))
+
+        # Share an in-flight fetch of the same message
+        if key in self._pending:
+            return(await asyncio.shield(self._pending[key]))
+
+        future = asyncio.ensure_future(channel.fetch_message(int(msg_id)))
+        self._pending[key] = future
+        try:
+            msg_ = await asyncio.shield(future)
+        finally:
+            # `invalidate()` drops the pending fetch, so if it's gone the
+            # message changed while it was being fetched: the result may be
+            # stale, so it's returned but not cached
+            current = self._pending.get(key) is future
+            if current:
+                del self._pending[key]
+
+        if current:
+            self._messages[key] = (msg_, time.monotonic())
+            self._messages.move_to_end(key)
+            while len(self._messages) > self.maxsize:
+                self._messages.popitem(last=False)
+        else:
+            log.debug(log_msg(['message_cache', 'invalidated_during_fetch', *key]))
+
+        return(msg_)
+
+    def invalidate(self, channel_id, msg_id):
+        """Drops a message from the cache (e.g., because it was edited or
+        deleted).
+        """
+        key = (channel_id, int(msg_id))
+        # Later fetches shouldn't share (or cache) a fetch started before
+        # the change
+        self._pending.pop(key, None)
+        if self._messages.pop(key, None) is not None:
+            log.debug(log_msg(['message_cache', 'invalidate', channel_id, msg_id]))
+
+    def stats(self):
+        """Returns `(hits, misses, size)`."""
+        return(self.hits, self.misses, len(self._messages))
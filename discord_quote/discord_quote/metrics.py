@@ -0,0 +1,263 @@
+import asyncio
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+# A minimal in-process metrics registry (counters and latency histograms,
+# with labels), served in the Prometheus text format by `serve()` on the
+# bot's own event loop. Metrics are safe to update from any thread.
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    return(str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"'))
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return('')
+    return('{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}')
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return(tuple(str(labels[name]) for name in self.labelnames))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return(lines)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return(self._values.get(self._key(labels), 0))
+
+    def _render_value(self, key, value):
+        return([f'{self.name}{_labels(self.labelnames, key)} {value}'])
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per-bucket counts..., +Inf count], sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the `with` block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return(sum(entry[0]) if entry else 0)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            lines.append(
+                f'{self.name}_bucket'
+                f'{_labels(self.labelnames, key, [("le", bound)])} {cumulative}'
+            )
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {total}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return(lines)
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name, help, labelnames=()):
+        return(self._register(Counter(name, help, labelnames)))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return(self._register(Histogram(name, help, labelnames, buckets)))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f'{metric.name} is already registered')
+        self._metrics[metric.name] = metric
+        return(metric)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return('\n'.join(lines) + '\n')
+
+REGISTRY = Registry()
+
+COMMAND_SECONDS = REGISTRY.histogram(
+    'quotebot_command_seconds',
+    'Time to run a bot command.',
+    ('command', 'outcome')
+)
+DISCORD_API_SECONDS = REGISTRY.histogram(
+    'quotebot_discord_api_seconds',
+    'Time taken by Discord API requests, by route.',
+    ('method', 'route')
+)
+DISCORD_API_REQUESTS = REGISTRY.counter(
+    'quotebot_discord_api_requests_total',
+    'Discord API requests, by route and the command that made them.',
+    ('method', 'route', 'command', 'outcome')
+)
+DB_SECONDS = REGISTRY.histogram(
+    'quotebot_db_seconds',
+    'Time the pin database connection was held, per query or write batch.',
+    ('op',)
+)
+BACKUP_SECONDS = REGISTRY.histogram(
+    'quotebot_backup_seconds',
+    'Time taken by S3 backups and restores.',
+    ('kind', 'outcome')
+)
+BACKUP_BYTES = REGISTRY.counter(
+    'quotebot_backup_bytes_total',
+    'Bytes uploaded to (or restored from) S3.',
+    ('kind',)
+)
+INFERENCE_SECONDS = REGISTRY.histogram(
+    'quotebot_model_inference_seconds',
+    'Time taken by author model predictions.'
+)
+
+# The command being run in the current task (and the tasks it starts), for
+# attributing Discord API requests
+current_command = contextvars.ContextVar('current_command', default='none')
+
+@contextmanager
+def track_request(method, route):
+    """Times a Discord API request made in the `with` block, and counts it
+    against the current command.
+    """
+    outcome = 'ok'
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        DISCORD_API_SECONDS.observe(time.perf_counter() - start,
+                                    method=method,
+                                    route=route)
+        DISCORD_API_REQUESTS.inc(method=method,
+                                 route=route,
+                                 command=current_command.get(),
+                                 outcome=outcome)
+
+def instrument_bot(bot):
+    """Times every command `bot` invokes, and every request its HTTP
+    client makes to the Discord API.
+    """
+    invoke = bot.invoke
+    request = bot.http.request
+
+    async def timed_invoke(ctx):
+        if ctx.command is None:
+            return(await invoke(ctx))
+
+        token = current_command.set(ctx.command.qualified_name)
+        start = time.perf_counter()
+        try:
+            await invoke(ctx)
+        finally:
+            current_command.reset(token)
+            outcome = 'error' if ctx.command_failed else 'ok'
+            COMMAND_SECONDS.observe(time.perf_counter() - start,
+                                    command=ctx.command.qualified_name,
+                                    outcome=outcome)
+
+    async def timed_request(route, **kwargs):
+        with track_request(route.method, route.path):
+            return(await request(route, **kwargs))
+
+    bot.invoke = timed_invoke
+    bot.http.request = timed_request
+
+async def _handle(reader, writer, registry):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the headers
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass
+
+        parts = request.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status = '200 OK'
+            body = registry.render().encode('utf-8')
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode('latin-1') + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError) as e:
+        log.debug(log_msg(['metrics', 'request_failed', e]))
+    finally:
+        writer.close()
+
+async def serve(host='127.0.0.1', port=9464, registry=REGISTRY):
+    """Serves `GET /metrics` (Prometheus text format) from the running
+    event loop. Returns the `asyncio.Server`.
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle(reader, writer, registry),
+        host,
+        port
+    )
+    log.info(log_msg(['metrics', 'serving', host,
+                      server.sockets[0].getsockname()[1]]))
+    return(server)
@@ -0,0 +1,417 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from utils import log_msg, parse_msg_url
+
+log = logging.getLogger(__name__)
+
+# Applied once, when the connection is opened.
+#   - WAL lets readers proceed while a write is in progress, and a crash
+#     mid-write leaves the main database file untouched.
+#   - synchronous=NORMAL is durable under WAL except for power loss, and
+#     avoids an fsync on every commit.
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS pins (
+    alias TEXT, msg_url TEXT, pin_user TEXT, pin_time TEXT
+    )
+    """,
+)
+
+def normalize_alias(alias):
+    """Returns the form of an alias that is stored in (and looked up by)
+    `pins.alias_norm`. Aliases are case-insensitive.
+    """
+    return(alias.strip().lower())
+
+# --- Schema migrations
+# Each migration takes the connection (inside a transaction) and upgrades
+# the schema by one version. `PRAGMA user_version` records how many have
+# been applied.
+def _migrate_guild_alias(conn):
+    """Scopes pins to a guild and adds a pre-normalized alias column, with
+    a unique `(guild_id, alias_norm)` index so alias lookups are index
+    probes instead of table scans.
+
+    The guild of existing pins is taken from their message url. If several
+    existing pins in a guild normalize to the same alias, the oldest one is
+    kept, and the others are logged and dropped.
+
+    Pins whose url has no guild (e.g., DM messages, or malformed urls) are
+    left with a NULL `guild_id`. No command can reach them any more; they
+    are logged, and kept only so they can be recovered by hand.
+    """
+    conn.execute("ALTER TABLE pins ADD COLUMN guild_id INTEGER")
+    conn.execute("ALTER TABLE pins ADD COLUMN alias_norm TEXT")
+
+    rows = conn.execute("SELECT rowid, alias, msg_url FROM pins").fetchall()
+    updates = []
+    for rowid, alias, msg_url in rows:
+        try:
+            guild_id, _, _ = parse_msg_url(msg_url)
+        except (ValueError, TypeError, AttributeError):
+            guild_id = None
+        updates.append((guild_id, normalize_alias(alias or ''), rowid))
+
+    conn.executemany(
+        "UPDATE pins SET guild_id = ?, alias_norm = ? WHERE rowid = ?",
+        updates
+    )
+
+    orphaned = [(rowid, alias, msg_url) for (guild_id, _, rowid), (_, alias, msg_url)
+                in zip(updates, rows) if guild_id is None]
+    for rowid, alias, msg_url in orphaned:
+        log.warning(log_msg(['db_migrate', 'pin_without_guild', rowid, alias, msg_url]))
+
+    # Orphaned pins (no guild) never collide: GROUP BY would lump their
+    # NULL guild ids together, and the unique index below doesn't
+    duplicate_rows = """
+        FROM pins WHERE guild_id IS NOT NULL AND rowid NOT IN (
+        SELECT min(rowid) FROM pins WHERE guild_id IS NOT NULL
+        GROUP BY guild_id, alias_norm
+        )
+        """
+    duplicates = conn.execute(
+        "SELECT rowid, guild_id, alias, msg_url " + duplicate_rows
+    ).fetchall()
+    for rowid, guild_id, alias, msg_url in duplicates:
+        log.warning(log_msg(['db_migrate', 'dropped_duplicate_alias',
+                             rowid, guild_id, alias, msg_url]))
+    conn.execute("DELETE " + duplicate_rows)
+
+    if orphaned or duplicates:
+        log.warning(log_msg(['db_migrate', 'guild_alias_summary',
+                             f'{len(orphaned)} without guild',
+                             f'{len(duplicates)} duplicates dropped']))
+
+    conn.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS pins_guild_alias
+        ON pins (guild_id, alias_norm)
+        """
+    )
+
+def _migrate_changelog(conn):
+    """Adds the `_changelog` table, which records every write made through
+    `PinDatabase.write()` so incremental backups can ship just the changes,
+    and `_backup_state`, which records where a backup snapshot is up to.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS _changelog (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, query TEXT, params TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS _backup_state (
+        key TEXT PRIMARY KEY, value
+        )
+        """
+    )
+
+def _migrate_snapshots(conn):
+    """Adds the ids of the pinned message (parsed from its url) and a
+    snapshot of its content, so `!list` can show previews without fetching
+    every message. Snapshots of existing pins are filled in later (see
+    `snapshot_time`, which is NULL until they are).
+    """
+    for column in ('channel_id INTEGER',
+                   'message_id INTEGER',
+                   'msg_author TEXT',
+                   'msg_created_at TEXT',
+                   'preview TEXT',
+                   'attachment_count INTEGER',
+                   'snapshot_time TEXT'):
+        conn.execute(f"ALTER TABLE pins ADD COLUMN {column}")
+
+    updates = []
+    for rowid, msg_url in conn.execute("SELECT rowid, msg_url FROM pins").fetchall():
+        try:
+            _, channel_id, message_id = parse_msg_url(msg_url)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        updates.append((channel_id, message_id, rowid))
+
+    conn.executemany(
+        "UPDATE pins SET channel_id = ?, message_id = ? WHERE rowid = ?",
+        updates
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS pins_message ON pins (message_id)")
+
+def _migrate_quotes(conn):
+    """Adds the `quotes` table, which records the chain (see `quote_chain`)
+    behind every quote the bot sends, keyed by the id of the sent message,
+    so requoting doesn't have to parse the quote's text.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS quotes (
+        message_id INTEGER PRIMARY KEY, guild_id INTEGER, channel_id INTEGER,
+        chain TEXT NOT NULL, quote_time TEXT
+        )
+        """
+    )
+
+def _migrate_guild_settings(conn):
+    """Adds the `guild_settings` table, for per-guild options (e.g., how
+    quotes render times). Guilds without a row use the defaults.
+    """
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS guild_settings (
+        guild_id INTEGER PRIMARY KEY, timestamp_style TEXT
+        )
+        """
+    )
+
+_MIGRATIONS = (
+    _migrate_guild_alias,
+    _migrate_changelog,
+    _migrate_snapshots,
+    _migrate_quotes,
+    _migrate_guild_settings,
+)
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i, migration in enumerate(_MIGRATIONS[version:], start=version + 1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {i}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        log.info(log_msg(['db_migrate', migration.__name__, i]))
+
+class PinDatabase:
+    """A single long-lived connection to the Sqlite3 pin database.
+
+    The connection is opened once (on the first query, or by `connect()`)
+    and shared by every query. Access to the connection is serialized with
+    a lock, and every write is committed (or rolled back) as a whole, so the
+    database is never left with a half-applied write.
+
+    Coroutines should use `fetch()` and `write()`, which run the queries on
+    a dedicated worker thread instead of blocking the event loop. Writes
+    that arrive within `batch_window` seconds of each other are committed
+    together in one transaction.
+
+    If `changelog` is set, every write made through `write()` is also
+    recorded (in the same transaction) in the `_changelog` table, for
+    incremental backups to ship. See `changes()`.
+
+    Use `snapshot()` to copy the database file anywhere (e.g., uploading a
+    backup), and call `close()` on shutdown.
+    """
+
+    def __init__(self, path, batch_window=0.005, changelog=False):
+        self.path = path
+        self.batch_window = batch_window
+        self.changelog = changelog
+        self._conn = None
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='pin_db')
+        self._pending_writes = []
+        self._flush_handle = None
+
+    def connect(self):
+        """Opens the connection (if it isn't already open), applies the
+        pragmas, creates the schema and runs any outstanding migrations.
+        Returns the connection.
+        """
+        with self._lock:
+            if self._conn is None:
+                # Autocommit mode: we manage transactions ourselves.
+                conn = sqlite3.connect(self.path, check_same_thread=False,
+                                       isolation_level=None)
+                for pragma in _PRAGMAS:
+                    conn.execute(pragma)
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+                _migrate(conn)
+
+                self._conn = conn
+                log.info(log_msg(['db_connect', self.path]))
+
+            return(self._conn)
+
+    def execute(self, query, params=()):
+        """Runs a single query (blocking) in its own transaction.
+
+        Returns all the results of the query.
+        """
+        with self._lock, metrics.DB_SECONDS.time(op='query'):
+            conn = self.connect()
+            c = conn.execute(query, params)
+            return(c.fetchall())
+
+    def execute_batch(self, statements):
+        """Runs a list of `(query, params)` writes (blocking) in a single
+        transaction. Each statement gets its own savepoint, so one failing
+        statement doesn't undo the others.
+
+        Returns a list with the results (or the exception) of each statement.
+        """
+        results = []
+        with self._lock, metrics.DB_SECONDS.time(op='write_batch'):
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for query, params in statements:
+                    conn.execute("SAVEPOINT pin_write")
+                    try:
+                        results.append(conn.execute(query, params).fetchall())
+                        if self.changelog:
+                            conn.execute(
+                                "INSERT INTO _changelog (query, params) VALUES (?, ?)",
+                                (query, json.dumps(params))
+                            )
+                    except sqlite3.Error as e:
+                        conn.execute("ROLLBACK TO pin_write")
+                        results.append(e)
+                    conn.execute("RELEASE pin_write")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        return(results)
+
+    async def fetch(self, query, params=()):
+        """Runs a query on the database worker thread.
+
+        Returns all the results of the query.
+        """
+        loop = asyncio.get_event_loop()
+        return(await loop.run_in_executor(
+            self._executor, self.execute, query, params
+        ))
+
+    async def write(self, query, params=()):
+        """Queues a write for the database worker thread, and waits until it
+        has been committed.
+
+        Returns all the results of the query.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending_writes.append((query, params, future))
+
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window,
+                                                 self._flush_writes)
+
+        return(await future)
+
+    def _flush_writes(self):
+        # Runs on the event loop: hand everything queued so far to the
+        # worker thread as one batch.
+        batch, self._pending_writes = self._pending_writes, []
+        self._flush_handle = None
+        if not batch:
+            return
+
+        loop = asyncio.get_event_loop()
+        done = loop.run_in_executor(
+            self._executor,
+            self.execute_batch,
+            [(query, params) for query, params, _ in batch]
+        )
+        done.add_done_callback(lambda f: self._resolve_writes(f, batch))
+
+        log.debug(log_msg(['db_write_batch', len(batch)]))
+
+    @staticmethod
+    def _resolve_writes(done, batch):
+        futures = [future for _, _, future in batch]
+        if done.exception() is not None:
+            results = [done.exception()] * len(futures)
+        else:
+            results = done.result()
+
+        for future, result in zip(futures, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def snapshot(self, path):
+        """Writes a consistent copy of the database (including anything
+        still in the write-ahead log) to `path`, using the Sqlite3 online
+        backup API. Writes are paused while the copy is taken.
+
+        Returns the `change_seq()` the copy is up to date with.
+        """
+        with self._lock:
+            dest = sqlite3.connect(path)
+            try:
+                self.connect().backup(dest)
+            finally:
+                dest.close()
+
+            return(self.change_seq())
+
+    def changes(self):
+        """Returns the `(seq, query, params)` of every change recorded in
+        the changelog (and not yet discarded), in order. `params` is JSON.
+        """
+        return(self.execute(
+            "SELECT seq, query, params FROM _changelog ORDER BY seq"
+        ))
+
+    def discard_changes(self, seq):
+        """Drops every change up to (and including) `seq` from the
+        changelog, once they have been backed up.
+        """
+        self.execute("DELETE FROM _changelog WHERE seq <= ?", (seq,))
+
+    def change_seq(self):
+        """Returns the sequence number of the latest change ever recorded
+        (0 if there hasn't been one). Discarding changes doesn't reset it.
+        """
+        row = self.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = '_changelog'"
+        )
+        return(row[0][0] if row else 0)
+
+    def checkpoint(self):
+        """Copies everything in the write-ahead log back into the main
+        database file, so that the file on disk is complete on its own.
+        """
+        with self._lock:
+            if self._conn is not None:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        """Waits for the worker thread to finish any queued work, then
+        checkpoints and closes the connection. The next (blocking) query
+        will re-open it.
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            if self._conn is not None:
+                self.checkpoint()
+                self._conn.close()
+                self._conn = None
+                log.info(log_msg(['db_close', self.path]))
@@ -0,0 +1,100 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+class CommandProfiler:
+    """Profiles command invocations with cProfile, writing one `.prof`
+    file (readable with `python -m pstats` or snakeviz) per profiled
+    invocation to `directory`.
+
+    Off until `enabled` is set. To cap the overhead, only one in every
+    `every` invocations is profiled, and only one at a time (an invocation
+    that starts while another is being profiled runs unprofiled). Only the
+    newest `max_files` profiles are kept.
+
+    Commands are coroutines, so a profile also includes whatever else the
+    event loop ran while the command was waiting.
+    """
+
+    def __init__(self, directory, every=1, max_files=50, enabled=False):
+        self.directory = directory
+        self.every = max(1, every)
+        self.max_files = max_files
+        self.enabled = enabled
+        self.profiled = 0
+        self.skipped = 0
+        self._seen = 0
+        self._active = False
+
+    async def run(self, name, coro):
+        """Awaits `coro` (the invocation of command `name`), profiling it
+        if it's due.
+        """
+        if not self.enabled or self._active:
+            if self.enabled:
+                self.skipped += 1
+            return(await coro)
+
+        self._seen += 1
+        if (self._seen - 1) % self.every:
+            return(await coro)
+
+        self._active = True
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            return(await coro)
+        finally:
+            profile.disable()
+            self._active = False
+            self._save(name, profile, time.perf_counter() - start)
+
+    def _save(self, name, profile, elapsed):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory,
+            f'{time.strftime("%Y%m%d-%H%M%S")}-{self.profiled:06d}-{name}-'
+            f'{elapsed * 1e3:.0f}ms.prof'
+        )
+        profile.dump_stats(path)
+        self.profiled += 1
+
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(5)
+        log.info(log_msg(['profile', name, f'{elapsed:.3f}s', path]))
+        log.debug(log_msg(['profile', name, summary.getvalue()]))
+
+        self._prune()
+
+    def _prune(self):
+        # Names start with the time (and a sequence number), so sort oldest
+        # first
+        profiles = sorted(name for name in os.listdir(self.directory)
+                          if name.endswith('.prof'))
+        for name in profiles[:max(0, len(profiles) - self.max_files)]:
+            os.remove(os.path.join(self.directory, name))
+
+    def status(self):
+        return(f"profiling {'on' if self.enabled else 'off'}: "
+               f"1 in {self.every} commands, {self.profiled} profiled, "
+               f"{self.skipped} skipped, newest {self.max_files} kept in "
+               f"{os.path.abspath(self.directory)}")
+
+def instrument_bot(bot, profiler):
+    """Runs every command `bot` invokes through `profiler`."""
+    invoke = bot.invoke
+
+    async def profiled_invoke(ctx):
+        if ctx.command is None:
+            return(await invoke(ctx))
+        return(await profiler.run(ctx.command.qualified_name, invoke(ctx)))
+
+    bot.invoke = profiled_invoke
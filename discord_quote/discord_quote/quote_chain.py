@@ -0,0 +1,62 @@
+import json
+
+# A quote chain records where a quote came from, so it can be requoted
+# without parsing the quote's text or fetching the messages it quotes:
+#
+#   {'source': {'author', 'content', 'created_at', 'jump_url',
+#               'guild_id', 'channel_id', 'channel_name', 'message_id'},
+#    'responses': [{'author', 'text', 'created_at', 'jump_url'}, ...]}
+#
+# `source` is the original (non-quote) message. Each response is a reply
+# added by someone quoting the chain; `created_at` and `jump_url` are those
+# of the quote the reply was posted in (None until it has been sent). A
+# response whose `text` is None is a "via" credit for a quote made without
+# a reply. Times are ISO 8601 strings (UTC).
+def start(msg_):
+    """Returns a new chain quoting the (non-quote) message `msg_`."""
+    return({
+        'source': {
+            'author': msg_.author.name,
+            'content': msg_.clean_content,
+            'created_at': msg_.created_at.isoformat(),
+            'jump_url': msg_.jump_url,
+            'guild_id': msg_.guild.id,
+            'channel_id': msg_.channel.id,
+            'channel_name': msg_.channel.name,
+            'message_id': msg_.id,
+        },
+        'responses': [],
+    })
+
+def respond(chain, author, text=None):
+    """Returns a copy of `chain` quoted by `author`, with the reply `text`.
+
+    Without a reply, `author` is credited with a "via" in place of the one
+    the chain ends with (if any); a chain that ends with a reply is
+    returned unchanged.
+    """
+    responses = chain['responses']
+    if text is None:
+        if responses and responses[-1]['text'] is not None:
+            return(chain)
+        if responses:
+            responses = responses[:-1]
+
+    response = {'author': author, 'text': text, 'created_at': None, 'jump_url': None}
+    return({'source': chain['source'], 'responses': [*responses, response]})
+
+def seal(chain, out):
+    """Records `out`, the message the chain was just sent as, as the time
+    and place of any responses that haven't been sent before.
+    """
+    for response in chain['responses']:
+        if response['text'] is not None and response['created_at'] is None:
+            response['created_at'] = out.created_at.isoformat()
+            response['jump_url'] = out.jump_url
+    return(chain)
+
+def dumps(chain):
+    return(json.dumps(chain, separators=(',', ':')))
+
+def loads(text):
+    return(json.loads(text))
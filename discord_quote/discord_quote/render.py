@@ -0,0 +1,129 @@
+import datetime
+
+import arrow
+
+# Everything the bot posts is built here. Each function builds its output
+# from a list of parts, joined once, so rendering is linear in the size of
+# the message, and fits it within Discord's message limit.
+LIMIT = 2000
+ELLIPSIS = '…'
+
+def block_format(message):
+    """Formats a message as a block quote (`> ` before every line)."""
+    return('> ' + message.replace('\n', '\n> '))
+
+def truncate(text, limit=LIMIT):
+    """Cuts `text` down to at most `limit` characters, marking the cut
+    with an ellipsis.
+    """
+    if len(text) <= limit:
+        return(text)
+    return(text[:max(limit - 1, 0)] + ELLIPSIS)
+
+def _fit(head, content, tail, limit):
+    # Block quotes `content` between `head` and `tail`, truncating the
+    # quoted content (rather than the attribution or the replies) to fit.
+    block = truncate(block_format(content), limit - len(head) - len(tail))
+    return(truncate(''.join((head, block, tail)), limit))
+
+# --- Times, in a guild's timestamp style (see `!timestamps`)
+def _arrow(value):
+    # Chains store times as ISO 8601 strings; parsing those with
+    # `datetime` is an order of magnitude faster than `arrow.get()`'s parser
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return(arrow.get(value))
+
+def relative_time(created_at, now, url, style='humanized'):
+    """Returns `created_at` relative to `now`, linked to `url`."""
+    time_ = _arrow(created_at)
+    if style == 'dynamic':
+        # Rendered (and kept up to date) by each reader's client
+        return(f"<t:{int(time_.float_timestamp)}:R> ([link](<{url}>))")
+    return(f"[{time_.humanize(_arrow(now))}](<{url}>)")
+
+def absolute_time(created_at, style='humanized'):
+    time_ = _arrow(created_at)
+    if style == 'dynamic':
+        return(f"<t:{int(time_.float_timestamp)}:f>")
+    return(time_.strftime('%Y-%m-%d %H:%M:%S'))
+
+# --- Quotes
+def webhook_quote(chain, now, style='humanized', limit=LIMIT):
+    """Renders a quote chain (see `quote_chain`) as a webhook quote: the
+    source message, linked, followed by each reply, with times relative
+    to `now`.
+    """
+    source = chain['source']
+    channel_url = (
+        f"https://discord.com/channels/"
+        f"{source['guild_id']}/{source['channel_id']}"
+    )
+    head = (
+        f"**{source['author']} said " +
+        relative_time(source['created_at'], now, source['jump_url'], style) +
+        f" in [#{source['channel_name']}](<{channel_url}>):**\n"
+    )
+
+    lines = []
+    for response in chain['responses']:
+        if response['text'] is None:
+            lines.append(f"_via {response['author']}_")
+        elif response['created_at']:
+            lines.append(
+                f"**{response['author']} responded " +
+                relative_time(response['created_at'],
+                              now,
+                              response['jump_url'],
+                              style) +
+                f":** {response['text']}"
+            )
+        else:
+            lines.append(reply_line(response['author'], response['text']))
+
+    return(_fit(head, source['content'], '\n' + '\n'.join(lines), limit))
+
+def plain_quote(chain, now, style='humanized', limit=LIMIT):
+    """Renders a quote chain as a plain (non-webhook) bot message, with
+    absolute times. Replies that haven't been sent yet are timed at `now`.
+    """
+    source = chain['source']
+    responses = chain['responses']
+
+    head = [f"**{source['author']} [{absolute_time(source['created_at'], style)}] said:**"]
+    if responses and responses[-1]['text'] is None:
+        head.append(f" _via {responses[-1]['author']}_")
+    head.append('\n')
+
+    tail = []
+    for response in responses:
+        if response['text'] is None:
+            continue
+        created_at = response['created_at'] or now
+        tail.append(
+            f"\n**{response['author']} [{absolute_time(created_at, style)}] " +
+            f"responded:** {response['text']}"
+        )
+
+    return(_fit(''.join(head), source['content'], ''.join(tail), limit))
+
+def reply_line(author, text):
+    return(f"**{author} responded:** {text}")
+
+# --- Other commands
+def misquote(name, minutes, content, likelihood=None, limit=LIMIT):
+    """Renders a misquote of `content`, attributed to `name` (with the
+    author model's `likelihood`, if it picked the name).
+    """
+    if likelihood is None:
+        head = f"**{name} definitely said {minutes} minutes ago:** \n"
+    else:
+        head = (
+            f"**{name} probably *({likelihood*100:.2f}%)* said " +
+            f"{minutes} minutes ago:** \n"
+        )
+    return(_fit(head, content, '', limit))
+
+def me(author, text, limit=LIMIT):
+    head = f"_{author} "
+    return(truncate(head + truncate(text, limit - len(head) - 1) + "_", limit))
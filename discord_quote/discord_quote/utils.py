@@ -1,4 +1,38 @@
+import atexit
+import copy
+import logging
+import logging.handlers
+import queue
 import re
+import sys
+
+# Fields longer than this are truncated when a log message is formatted
+# (None for no limit). Set by `configure_logging()`.
+_FIELD_LIMIT = None
+
+class LogMessage:
+    """A log message built by `log_msg()`. Its fields are only converted
+    to strings, truncated and joined when the record is actually handled
+    (by the thread that logged it), so messages below the logging level
+    cost next to nothing.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def message_type(self):
+        return(str(self.data[0]) if self.data else '')
+
+    def __str__(self):
+        tmp = []
+        for d in self.data:
+            d = str(d).replace(u'\u241e', ' ')
+            if _FIELD_LIMIT is not None and len(d) > _FIELD_LIMIT:
+                d = f'{d[:_FIELD_LIMIT]}…(+{len(d) - _FIELD_LIMIT})'
+            tmp.append(d)
+        return u'\u241e'.join(tmp)
 
 def log_msg(data):
     """
@@ -10,25 +44,101 @@ def log_msg(data):
         {message_type}\u241e{data}
 
     where {data} should be a \u241e delimited row.
+
+    Returns a `LogMessage`, which does the formatting lazily (when the
+    log record is emitted), so pass it straight to the logger.
     """
-    tmp = [str(d).replace(u'\u241e', ' ') for d in data]
-    return u'\u241e'.join(tmp)
+    return LogMessage(data)
 
-# Format a message as a block quotes.
-def block_format(message):
+class SampleFilter(logging.Filter):
+    """Keeps only one in every `n` records of each sampled message type,
+    e.g., `SampleFilter({'message_cache': 10})`. Records of other types
+    (or not built with `log_msg()`) always pass.
+    """
 
-    # Find new line positions
-    insert_idx = [pos for pos, char in enumerate(message) if char == "\n"]
-    insert_idx.insert(0, -1)
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self._counts = {}
+
+    def filter(self, record):
+        if not isinstance(record.msg, LogMessage):
+            return True
+        message_type = record.msg.message_type
+        n = self.rates.get(message_type)
+        if not n:
+            return True
+        count = self._counts.get(message_type, 0)
+        self._counts[message_type] = count + 1
+        return count % n == 0
+
+def parse_sample_rates(spec):
+    """Parses `'type=n,type=n'` into `{type: n}` (for `SampleFilter`)."""
+    rates = {}
+    for item in spec.split(','):
+        if item.strip():
+            message_type, n = item.split('=')
+            rates[message_type.strip()] = int(n)
+    return(rates)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # `log_msg()` fields are live objects (messages, contexts, exceptions)
+    # that the event loop may change before the listener thread gets to
+    # them, so the message and any traceback are turned into text here, in
+    # the caller. Like the stock `prepare()`, but only the message is
+    # formatted: the listener adds the time, logger and level.
+    def prepare(self, record):
+        message = self.format(record)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        record.stack_info = None
+        return(record)
+
+def configure_logging(level=logging.DEBUG, loggers=(), field_limit=None,
+                      sample_rates=None, stream=None):
+    """Sends all logging through a queue to a background thread, which
+    formats and writes the records to `stream` (stdout by default), so
+    logging never blocks the event loop on I/O.
+
+    The loggers named in `loggers` log at `level`; everything else (e.g.,
+    discord.py) only at WARNING. Fields of `log_msg()` messages are cut to
+    `field_limit` characters, and `sample_rates` (see `SampleFilter`)
+    thins out noisy message types.
+
+    Returns the started `QueueListener`, which is stopped (flushing any
+    queued records) at exit.
+    """
+    global _FIELD_LIMIT
+    _FIELD_LIMIT = field_limit
 
-    # Insert "> " for block quote formatting
-    for offset, i in enumerate(insert_idx):
+    fmt = logging.Formatter(u'\u241e'.join(['%(asctime)s',
+                                            '%(name)s',
+                                            '%(levelname)s',
+                                            '%(funcName)s',
+                                            '%(message)s']))
+    stream_handler = logging.StreamHandler(stream=stream or sys.stdout)
+    stream_handler.setFormatter(fmt)
 
-        message = (message[:i + (2 * offset) + 1] + 
-                  "> " + 
-                  message[i + (2 * offset) + 1:])
+    records = queue.SimpleQueue()
+    queue_handler = _QueueHandler(records)
+    if sample_rates:
+        queue_handler.addFilter(SampleFilter(sample_rates))
 
-    return(message)
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(logging.WARNING)
+    for name in loggers:
+        logging.getLogger(name).setLevel(level)
+
+    listener = logging.handlers.QueueListener(records, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return(listener)
 
 def parse_msg_url(url):
     """
@@ -45,3 +155,45 @@ def parse_msg_url(url):
     server, channel, message = re.search(url_template, url).groups()
 
     return int(server), int(channel), int(message)
+
+def chunk_lines(lines, limit=2000, header=''):
+    """
+    Joins lines (with newlines) into as few messages as possible, each at
+    most `limit` characters (Discord's message limit), only splitting
+    between lines. `header`, if given, starts the first message. Lines
+    longer than `limit` are truncated.
+    """
+    chunks = []
+    current = [header] if header else []
+    size = len(header) if header else -1
+
+    for line in lines:
+        line = line[:limit]
+        if current and size + 1 + len(line) > limit:
+            chunks.append('\n'.join(current))
+            current, size = [], -1
+        current.append(line)
+        size += 1 + len(line)
+
+    if current:
+        chunks.append('\n'.join(current))
+
+    return(chunks)
+
+def text_preprocess(msg_text):
+    """Normalizes a message for the author model: drops emotes and some
+    markdown, pads punctuation with spaces, and lower-cases it. (Lives here
+    rather than in `author_model`, so it doesn't need torch.)
+    """
+
+    # Remove emotes
+    msg = re.sub(r"([\<]).*?([\>])", "", msg_text).strip()
+
+    # Pad punctuation with spaces
+    msg = re.sub(r"([,.!?\(\)\[\]\{\}:;])", r" \1 ", msg)
+
+    # Remove some markdown characters
+    msg = re.sub(r"([`_*])", r"", msg)
+
+    # lower case
+    return msg.lower()
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import time
+
+from utils import log_msg
+
+log = logging.getLogger(__name__)
+
+class WebhookCache:
+    """Caches the webhook used to quote into each channel, and whether the
+    bot is allowed to manage webhooks there.
+
+    A channel's webhook is looked up (or created) once, under a per-channel
+    lock so two quotes arriving together can't both create one. Call
+    `revalidate()` when the channel's webhooks change, `invalidate()` when
+    a send returns 404, and `invalidate_permissions()` when roles or channel overwrites
+    change. Permission results also expire after `permission_ttl` seconds.
+    """
+
+    def __init__(self, permission_ttl=300):
+        self.permission_ttl = permission_ttl
+        self._hooks = {}
+        self._locks = {}
+        self._permissions = {}
+
+    def can_manage(self, channel, member):
+        """Returns whether `member` has the 'Manage Webhooks' permission in
+        `channel`.
+        """
+        entry = self._permissions.get(channel.id)
+        if entry is not None and time.monotonic() - entry[2] < self.permission_ttl:
+            return(entry[1])
+
+        allowed = channel.permissions_for(member).manage_webhooks
+        self._permissions[channel.id] = (channel.guild.id, allowed, time.monotonic())
+        return(allowed)
+
+    async def get(self, channel, name):
+        """Returns the webhook for `channel`, using the channel's first
+        existing webhook or creating one called `name`.
+        """
+        hook = self._hooks.get(channel.id)
+        if hook is not None:
+            return(hook)
+
+        async with self._locks.setdefault(channel.id, asyncio.Lock()):
+            # Someone else may have found it while we waited for the lock
+            hook = self._hooks.get(channel.id)
+            if hook is not None:
+                return(hook)
+
+            webhooks = await channel.webhooks()
+            if webhooks:
+                # If there's an existing webhook, just use that.
+                hook = webhooks[0]
+                log.info(log_msg(['webhook_found', hook.name]))
+            else:
+                log.info(log_msg(['webhook_not_found']))
+
+                # Otherwise, create a webhook.
+                hook = await channel.create_webhook(name=name)
+                log.info(log_msg(['webhook_created', hook.name]))
+
+            self._hooks[channel.id] = hook
+
+        return(hook)
+
+    async def revalidate(self, channel):
+        """Forgets the webhook for `channel` unless it's still one of the
+        channel's webhooks. For webhooks update events, which Discord also
+        sends when `get()` creates the webhook. Raises whatever
+        `channel.webhooks()` raises.
+        """
+        if channel.id not in self._hooks:
+            return
+
+        async with self._locks.setdefault(channel.id, asyncio.Lock()):
+            hook = self._hooks.get(channel.id)
+            if hook is None:
+                return
+            if hook.id not in {webhook.id for webhook in await channel.webhooks()}:
+                self.invalidate(channel.id)
+
+    def invalidate(self, channel_id):
+        """Forgets the webhook for a channel."""
+        if self._hooks.pop(channel_id, None) is not None:
+            log.info(log_msg(['webhook_invalidated', channel_id]))
+
+    def invalidate_permissions(self, channel_id=None, guild_id=None):
+        """Forgets the cached permissions for a channel, or for every
+        channel in a guild.
+        """
+        if channel_id is not None:
+            self._permissions.pop(channel_id, None)
+        if guild_id is not None:
+            self._permissions = {
+                key: entry for key, entry in self._permissions.items()
+                if entry[0] != guild_id
+            }
@@ -0,0 +1,123 @@
+"""Tests for re-humanizing the times in a requote (`_format_quote()`): the
+earlier messages of a chain are fetched concurrently, each one once, and
+jump urls on both discord.com and discordapp.com are recognized.
+"""
+import asyncio
+import collections
+import datetime
+import importlib
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+
+LATENCY = 0.05
+
+@pytest.fixture(scope='module')
+def bot(tmp_path_factory):
+    # Offline: no backups, and a throwaway database (opened relative to
+    # the working directory)
+    db = tmp_path_factory.mktemp('db') / 'pins.db'
+    env = {
+        'DISCORD_QUOTEBOT_BUCKET': '',
+        'DISCORD_QUOTEBOT_DB_FILENAME': os.path.relpath(db, BOT_DIR),
+        'DISCORD_QUOTEBOT_METRICS_PORT': '0',
+        'DISCORD_QUOTEBOT_LOG_LEVEL': 'WARNING',
+    }
+    saved = {name: os.environ.get(name) for name in env}
+    cwd = os.getcwd()
+    os.environ.update(env)
+    os.chdir(BOT_DIR)
+    sys.path.insert(0, BOT_DIR)
+    try:
+        yield importlib.import_module('discord_quote')
+    finally:
+        os.chdir(cwd)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def make_quote(refs, now):
+    """Builds a requote whose lines point (through jump urls on the given
+    domains) at the message ids in `refs`, and a channel that serves those
+    messages, counting fetches.
+    """
+    fetches = collections.Counter()
+    channel = SimpleNamespace(id=2, name='general')
+    guild = SimpleNamespace(id=1, get_channel=lambda channel_id: channel)
+
+    async def fetch_message(msg_id):
+        fetches[int(msg_id)] += 1
+        await asyncio.sleep(LATENCY)
+        return(SimpleNamespace(
+            id=int(msg_id),
+            created_at=now - datetime.timedelta(hours=int(msg_id) - 1000 + 2),
+            author=SimpleNamespace(name=f'user{msg_id}'),
+            clean_content=f'message {msg_id}',
+        ))
+    channel.fetch_message = fetch_message
+
+    lines = []
+    for level, (domain, msg_id) in enumerate(refs):
+        action = 'said' if level == 0 else 'responded'
+        lines.append(f"**user{msg_id} {action} [a while ago]"
+                     f"(<https://{domain}/channels/1/2/{msg_id}>):** message {msg_id}")
+    lines.append("**requoter responded:** the end")
+
+    quote = SimpleNamespace(id=2000,
+                            content='\n'.join(lines),
+                            created_at=now,
+                            jump_url='https://discord.com/channels/1/2/2000')
+    ctx = SimpleNamespace(
+        channel=channel,
+        guild=guild,
+        message=SimpleNamespace(created_at=now,
+                                channel=channel,
+                                author=SimpleNamespace(name='requoter')),
+    )
+    return(ctx, quote, fetches)
+
+def format_quote(bot, ctx, quote):
+    from message_cache import MessageCache
+    bot.messages = MessageCache()    # cold cache
+    start = time.perf_counter()
+    output = asyncio.run(bot._format_quote(ctx, quote))
+    return(output, time.perf_counter() - start)
+
+def test_ten_deep_chain_is_fetched_concurrently(bot):
+    now = datetime.datetime.utcnow()
+    depth = 10
+    ctx, quote, fetches = make_quote(
+        [('discord.com', 1000 + level) for level in range(depth)], now)
+
+    output, elapsed = format_quote(bot, ctx, quote)
+    print(f"\n10-deep chain, {LATENCY * 1e3:.0f} ms per fetch: "
+          f"{elapsed * 1e3:.1f} ms end to end")
+
+    assert 'a while ago' not in output
+    assert output.count('hours ago') == depth
+    assert fetches == {1000 + level: 1 for level in range(depth)}
+    # Sequential fetches would take depth * LATENCY
+    assert elapsed < depth * LATENCY / 2
+
+def test_repeated_messages_are_fetched_once(bot):
+    now = datetime.datetime.utcnow()
+    refs = [('discord.com', 1000), ('discordapp.com', 1001),
+            ('discordapp.com', 1000), ('discord.com', 1001),
+            ('discord.com', 1002), ('discord.com', 1000)]
+    ctx, quote, fetches = make_quote(refs, now)
+
+    output, _ = format_quote(bot, ctx, quote)
+
+    assert fetches == {1000: 1, 1001: 1, 1002: 1}
+    assert 'a while ago' not in output
+    # Both url forms are kept as they were
+    assert 'https://discordapp.com/channels/1/2/1001' in output
+    assert 'https://discord.com/channels/1/2/1002' in output
@@ -0,0 +1,41 @@
+"""Tests for the queued logging set up by `configure_logging()`: records
+are written as they were when logged, even if their fields change
+before the listener thread writes them.
+"""
+import atexit
+import io
+import logging
+import os
+import sys
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BOT_DIR)
+
+import utils
+
+def test_fields_are_formatted_when_logged():
+    stream = io.StringIO()
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    listener = utils.configure_logging(loggers=['test_logging'], stream=stream)
+    queue_handler = root.handlers[-1]
+    try:
+        log = logging.getLogger('test_logging')
+        state = ['before']
+        log.info(utils.log_msg(['state', state]))
+        state[0] = 'after'
+
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            log.error(utils.log_msg(['failed']), exc_info=True)
+    finally:
+        listener.stop()
+        atexit.unregister(listener.stop)
+        root.removeHandler(queue_handler)
+        assert root.handlers == handlers
+
+    lines = stream.getvalue()
+    assert "state␞['before']" in lines
+    assert lines.count('ValueError: boom') == 1
@@ -0,0 +1,47 @@
+"""Tests for the pin database migrations: scoping pins to a guild keeps
+the oldest of each guild's duplicate aliases, and keeps every pin without
+a guild.
+"""
+import os
+import sqlite3
+import sys
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BOT_DIR)
+
+from pin_db import PinDatabase
+
+def make_v0_database(path, pins):
+    """A database from before any migration, with `pins` as
+    `(alias, msg_url)` rows.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE pins (alias TEXT, msg_url TEXT, pin_user TEXT, pin_time TEXT)")
+    conn.executemany("INSERT INTO pins VALUES (?, ?, 'someone', '2020-06-01 12:00:00')",
+                     pins)
+    conn.commit()
+    conn.close()
+
+def test_guild_alias_migration_keeps_orphaned_pins(tmp_path):
+    path = str(tmp_path / 'pins.db')
+    make_v0_database(path, [
+        ('Lol', 'https://discord.com/channels/1/2/100'),
+        ('lol', 'https://discord.com/channels/1/2/101'),     # duplicate in guild 1
+        ('lol', 'https://discord.com/channels/9/2/102'),     # another guild
+        ('dm', 'https://discord.com/channels/@me/2/103'),    # orphaned
+        ('DM', 'not a url'),                                 # orphaned, same alias
+    ])
+
+    db = PinDatabase(path)
+    try:
+        rows = db.execute("SELECT guild_id, alias_norm, msg_url FROM pins ORDER BY rowid")
+    finally:
+        db.close()
+
+    assert rows == [
+        (1, 'lol', 'https://discord.com/channels/1/2/100'),
+        (9, 'lol', 'https://discord.com/channels/9/2/102'),
+        (None, 'dm', 'https://discord.com/channels/@me/2/103'),
+        (None, 'dm', 'not a url'),
+    ]
@@ -0,0 +1,57 @@
+"""Tests for the author model's prediction cache: a cached prediction is
+the message's own, however it was batched when it was computed.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'discord_quote', 'discord_quote')
+sys.path.insert(0, BOT_DIR)
+
+import author_model
+from AuthorNet import AuthorNet
+
+@pytest.fixture
+def model(monkeypatch):
+    torch.manual_seed(0)
+    vocab = author_model.Vocab(['<unk>', '<pad>'] + [f'word{i}' for i in range(50)])
+    net = AuthorNet(24, 11, vocab)
+    # Non-trivial batch norm statistics, so that padding shows
+    for bn in (net.bn1, net.bn2, net.bn3):
+        bn.running_mean.normal_(0, 0.5)
+        bn.running_var.uniform_(0.5, 2)
+    net.eval()
+
+    monkeypatch.setattr(author_model, '_NET', net)
+    monkeypatch.setattr(author_model, '_VOCAB', vocab)
+    monkeypatch.setattr(author_model, '_MODEL_VERSION', ('test',))
+    monkeypatch.setattr(author_model, 'PREDICTIONS', author_model.PredictionCache())
+    author_model.PREDICTIONS.invalidate(('test',))
+    return(net, vocab)
+
+def alone(text, hour, net, vocab):
+    obs = author_model.msg_to_input(text, hour, vocab)
+    return(author_model.predict_batch([obs], net=net, vocab=vocab)[0].tolist())
+
+def test_cached_prediction_matches_unbatched(model):
+    net, vocab = model
+    random.seed(0)
+    words = vocab.itos[2:]
+    requests = [(' '.join(random.choices(words, k=length)), random.randrange(24))
+                for length in (3, 4, 5, 6, 6, 9, 12, 13)]
+
+    batched = author_model.predict_probabilities(requests, max_pad=4)
+    # Some messages were padded, or this tests nothing
+    assert any(max(abs(p - q) for p, q in zip(out, alone(text, hour, net, vocab))) > 1e-6
+               for out, (text, hour) in zip(batched, requests))
+
+    _, _, size = author_model.PREDICTIONS.stats()
+    assert 0 < size < len(requests)
+    for text, hour in requests:
+        cached = author_model.predict_probabilities([(text, hour)])[0]
+        assert cached == pytest.approx(alone(text, hour, net, vocab), abs=1e-6)